@@ -0,0 +1,34 @@
+from fasterrl.common.experiment import BatchedTabularExperiment
+
+# all trials run at once, in a native vectorized version of the environment
+params = {
+    "PLATFORM": "native",
+    "ENV_NAME": "FrozenLakeNotSlippery-v0",
+    "METHOD": "QLearning",
+    "LOG_LEVEL": 2,
+    "NUMBER_EPISODES_MEAN": 10,
+    "MEAN_REWARD_BOUND": .8,
+    "NUM_TRIALS": 100,
+    "BATCH_TRIALS": 100,
+    "MAX_EPISODES": 1000,
+    "EPSILON_DECAY_LAST_FRAME": 4000,
+    "EPSILON_START": 1.0,
+    "EPSILON_FINAL": 0,
+    "LEARNING_RATE": 0.3,
+    "GAMMA": 0.99
+}
+
+results = []
+methods = ["QLearning", "Sarsa"]
+for method in methods:
+    params["METHOD"] = method
+    exp = BatchedTabularExperiment(params)
+    result = exp.run()
+    results.append(result)
+
+for method, result in zip(methods, results):
+    print("Method {} took an average of {:.2f} episodes".format(method, result))
+
+# For "FrozenLakeNotSlippery-v0", 100 trials in less than a second each
+# Method QLearning took an average of 320.99 episodes
+# Method Sarsa took an average of 320.75 episodes
@@ -0,0 +1,48 @@
+from fasterrl.common.experiment import ActorLearnerExperiment
+
+"""
+    LOG LEVELS:
+    1 - report nothing, just run
+    2 - print to screen
+    3 - log episode-wise variables
+    4 - log step-wise variable
+    5 - log specifics relevant for debugging
+"""
+
+params = {
+    "PLATFORM": "native",
+    "ENV_NAME": "CartPole-v0",
+    "METHOD": "DQN",
+    "LOGGER_METHOD": "DQNLogger",
+    "NETWORK_TYPE": "SimpleValueNetwork",
+    "REPORTING_INTERVAL": 10,
+    "LOG_LEVEL": 2, #debugging level
+    "NUMBER_EPISODES_MEAN": 10,
+    "MEAN_REWARD_BOUND": 195,
+    "NUM_TRIALS": 1,
+    "MAX_EPISODES": 3000,
+    "EPSILON_DECAY_LAST_FRAME": 3000, # per actor
+    "EPSILON_START": 1.0,
+    "EPSILON_FINAL": 0.02,
+    "LEARNING_RATE": 1e-3,
+    "GAMMA": 0.99,
+    "REPLAY_BATCH_SIZE": 32,
+    "EXPERIENCE_BUFFER_SIZE": 5000,
+    "BUFFER_STORAGE": "array",
+    "DOUBLE_QLEARNING": True,
+    "SOFT_UPDATE": True,
+    "SOFT_UPDATE_TAU": 5e-3,
+    # actors and learner
+    "NUM_ACTORS": 3,
+    "ACTOR_CHUNK_SIZE": 64,
+    "ACTOR_QUEUE_SIZE": 16,
+    "ACTOR_SYNC_STEPS": 100,
+    "WEIGHTS_PUBLISH_UPDATES": 20,
+    "UPDATE_TO_DATA_RATIO": 1.0,
+}
+
+# actor processes may be spawned, which imports this module again
+if __name__ == "__main__":
+    exp = ActorLearnerExperiment(params)
+    result = exp.run()
+    print("Method {} took an average of {:.2f} episodes".format(params["METHOD"], result))
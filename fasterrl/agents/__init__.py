@@ -1,9 +1,10 @@
 from .base_agent import BaseAgent, ValueBasedAgent
 from .td_learning import TDLearning, QLearning, Sarsa
 from .td_learning import NStepsTDLearning, NStepsQLearning, NStepsSarsa
+from .batched_td_learning import BatchedTDLearning, BatchedQLearning, BatchedSarsa
 from .monte_carlo import FirstVisitMonteCarlo, EveryVisitMonteCarlo
 from .policy_gradient import CrossEntropy, MonteCarloReinforce, BatchReinforce, ContinuousMonteCarloReinforce, ContinuousBatchReinforce
 from .actor_critic import A2C
 from .ddpg import DDPG
-from .dqn import DQN
+from .dqn import DQN, DQNActor
 
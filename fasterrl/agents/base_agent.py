@@ -2,6 +2,9 @@ from numpy import random
 
 class BaseAgent():
 
+    # agents that act in all copies of a vectorized environment at once, required for NUM_ENVS > 1
+    vectorized = False
+
     def __init__(self, params):
 
         # self.params = params
@@ -29,12 +32,23 @@ class BaseAgent():
         # completion status, useful for multiagent systems
         self.completed = False 
 
+        # identifies the agent in logs and files. experiments override it with set_alias
+        self.alias = "agent"
+
+        # experiment and trial the agent runs in, used to keep local files of different runs apart
+        self.run_id = "run"
+        self.trial = 0
+
     def set_environment(self, env):
         self.env = env
 
     def set_alias(self, alias):
         self.alias = alias
 
+    def set_run(self, run_id, trial):
+        self.run_id = run_id
+        self.trial = trial
+
     def reset(self):
         self.state = self.env.reset()
 
@@ -71,6 +85,9 @@ class BaseAgent():
     def learn(self, action, next_state, reward, done):
         pass # no learning in random action agents
 
+    def close(self):
+        pass # release resources held by the agent, such as background threads
+
 class ValueBasedAgent(BaseAgent):
 
     def __init__(self, params):
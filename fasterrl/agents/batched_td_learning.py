@@ -0,0 +1,83 @@
+from fasterrl.agents.base_agent import ValueBasedAgent
+from fasterrl.common.exploration import greedy_action
+import numpy as np
+
+class BatchedTDLearning(ValueBasedAgent):
+    """ Independent tabular agents, one per environment of a vectorized environment, advanced in lockstep.
+
+        Q-tables of all agents are stacked in a single array of shape (agents, states, actions),
+        so action selection and updates are a single operation for all agents.
+        States and actions are ints, as in discrete environments
+    """
+
+    def __init__(self, params):
+        super(BatchedTDLearning, self).__init__(params)
+
+        self.td_type = "QLearning"
+        if "TD_TYPE" in params:
+            self.td_type = params["TD_TYPE"]
+
+    def set_environment(self, env):
+        super(BatchedTDLearning, self).set_environment(env)
+
+        self.num_agents = env.num_envs
+        self.agent_index = np.arange(self.num_agents)
+        self.qtable = np.zeros((self.num_agents, env.observation_space.n, self.num_actions))
+
+        # agents that stopped learning, such as the ones that solved the environment, are not updated
+        self.active = np.ones(self.num_agents, dtype=bool)
+
+    def reset(self):
+        super(BatchedTDLearning, self).reset()
+
+        # in SARSA, the action for the next state is chosen when learning, and played in the next step
+        self.next_actions = None
+
+    def select_actions(self, states):
+        """ Epsilon greedy action of each agent, with ties broken at random """
+
+        actions = greedy_action(self.qtable[self.agent_index, states])
+        explore = np.random.rand(self.num_agents) < self.epsilon
+        actions[explore] = np.random.randint(self.num_actions, size=explore.sum())
+
+        return actions
+
+    def play_step(self):
+        """ Step all agents. Returns the done of each agent """
+
+        if self.next_actions is not None:
+            actions = self.next_actions
+        else:
+            actions = self.select_actions(self.state)
+
+        next_states, rewards, dones, _ = self.env.step(actions)
+        self.learn(actions, next_states, rewards, dones)
+
+        # environments that finished are already reset
+        self.state = next_states
+        self.step_reward = rewards
+        self.update_params()
+
+        return dones
+
+    def learn(self, actions, next_states, rewards, dones):
+
+        next_qvalues = self.qtable[self.agent_index, next_states]
+        if self.td_type == "QLearning":
+            next_values = next_qvalues.max(axis=1)
+        elif self.td_type == "SARSA":
+            self.next_actions = self.select_actions(next_states)
+            next_values = next_qvalues[self.agent_index, self.next_actions]
+
+        # td target is only the reward when the episode is done
+        td_target = rewards + self.gamma * next_values * ~dones
+        td_error = td_target - self.qtable[self.agent_index, self.state, actions]
+        self.qtable[self.agent_index, self.state, actions] += self.learning_rate * td_error * self.active
+
+class BatchedQLearning(BatchedTDLearning):
+    pass
+
+class BatchedSarsa(BatchedTDLearning):
+    def __init__(self, params):
+        super(BatchedSarsa, self).__init__(params)
+        self.td_type = "SARSA"
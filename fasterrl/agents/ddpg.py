@@ -1,8 +1,9 @@
 # ddpg.py
 from fasterrl.agents.base_agent import ValueBasedAgent
 from fasterrl.common.network import *
-from fasterrl.common.buffer import Experience, ExperienceBuffer
+from fasterrl.common.buffer import Experience, ExperienceBuffer, ExperienceArray, ArrayExperienceBuffer
 from fasterrl.common.exploration import OUNoise
+from fasterrl.common.prefetcher import SynchronizedBuffer, BatchPrefetcher
 
 import torch
 import torch.optim as optim
@@ -77,8 +78,34 @@ class DDPG(ValueBasedAgent):
             if "SYNC_TARGET_FRAMES" in params:
                 self.sync_target_frames = params["SYNC_TARGET_FRAMES"]
 
+        # how experiences are kept in the replay buffer
+        # deque: list of experience tuples; array: preallocated columnar arrays
+        buffer_storage = "deque"
+        if "BUFFER_STORAGE" in params:
+            buffer_storage = params["BUFFER_STORAGE"]
+
         # initialize experience buffer
-        self.buffer = ExperienceBuffer(experience_buffer_size)
+        # with columnar storage, batches are written into tensors reused at every step
+        # states and actions are stored as float32, the type used by the networks
+        self.tensor_sampling = buffer_storage == "array"
+        if buffer_storage == "array":
+            self.buffer = ArrayExperienceBuffer(experience_buffer_size, ExperienceArray(experience_buffer_size, np.float32))
+        else:
+            self.buffer = ExperienceBuffer(experience_buffer_size)
+
+        # prepare the next minibatches as tensors in a background thread
+        # number of batches prepared ahead of time, 0 to disable
+        self.prefetch_batches = 0
+        if "PREFETCH_BATCHES" in params:
+            self.prefetch_batches = params["PREFETCH_BATCHES"]
+        self.prefetch_pin_memory = False
+        if "PREFETCH_PIN_MEMORY" in params:
+            self.prefetch_pin_memory = params["PREFETCH_PIN_MEMORY"]
+        self.prefetcher = None
+
+        # buffer will be sampled from another thread
+        if self.prefetch_batches:
+            self.buffer = SynchronizedBuffer(self.buffer)
 
     def set_environment(self, env):
 
@@ -130,19 +157,31 @@ class DDPG(ValueBasedAgent):
 
         return action_values
 
-    def unpack_batch(self, batch):
+    def unpack_batch(self, batch, device=None):
 
         states, actions, rewards, dones, next_states = batch
 
+        if device is None:
+            device = self.device
+
         # creates tensors. and push them to device, if GPU is available, then uses GPU
-        states_v = torch.FloatTensor(states).to(self.device)
-        next_states_v = torch.FloatTensor(next_states).to(self.device)
-        rewards_v = torch.FloatTensor(rewards).to(self.device)
-        actions_v = torch.FloatTensor(actions).to(self.device)
-        done_mask = torch.ByteTensor(dones).to(self.device)
+        states_v = torch.FloatTensor(states).to(device)
+        next_states_v = torch.FloatTensor(next_states).to(device)
+        rewards_v = torch.FloatTensor(rewards).to(device)
+        actions_v = torch.FloatTensor(actions).to(device)
+        # bool mask, used to index next state values
+        done_mask = torch.as_tensor(dones, dtype=torch.bool).to(device)
 
         return states_v, next_states_v, rewards_v, actions_v, done_mask
 
+    def unpack_tensors(self, batch_v):
+        """ Reorder tensors sampled from the buffer to the order returned by unpack_batch """
+
+        states_v, actions_v, rewards_v, done_mask, next_states_v = batch_v
+
+        # actions keep the type given by the environment, networks expect float32
+        return states_v, next_states_v, rewards_v, actions_v.float(), done_mask
+
     def learn(self, action, next_state, reward, done):
 
         # append experience to buffer
@@ -151,10 +190,17 @@ class DDPG(ValueBasedAgent):
         ## learn when there are enough batch samples
         ## ideally I should accumulate a mass of experiences before starting to learn
         if len(self.buffer) > self.replay_batch_size:
-            # sample from buffer
-            batch = self.buffer.sample(self.replay_batch_size)
+            # sample from buffer, or get the batch prepared in the background
+            if self.prefetch_batches:
+                if self.prefetcher is None:
+                    self.start_prefetcher()
+                batch_v = self.prefetcher.get().tensors
+            elif self.tensor_sampling:
+                batch_v = self.unpack_tensors(self.buffer.sample_tensors(self.replay_batch_size, self.device))
+            else:
+                batch_v = self.unpack_batch(self.buffer.sample(self.replay_batch_size))
             # unpack vectors of variables
-            states_v, next_states_v, rewards_v, actions_v, done_mask = self.unpack_batch(batch)
+            states_v, next_states_v, rewards_v, actions_v, done_mask = batch_v
 
             #### train critic
             # zero gradients
@@ -193,6 +239,24 @@ class DDPG(ValueBasedAgent):
             actor_loss_v.backward()
             self.actor_optimizer.step()
 
+    def start_prefetcher(self):
+        """ Start preparing batches in a background thread """
+
+        # with pinned memory, tensors are created in cpu and copied asynchronously by the prefetcher
+        prepare = self.unpack_batch
+        if self.prefetch_pin_memory:
+            prepare = lambda batch: self.unpack_batch(batch, device=torch.device("cpu"))
+
+        self.prefetcher = BatchPrefetcher(self.buffer, self.replay_batch_size, prepare,
+            self.prefetch_batches, self.device, self.prefetch_pin_memory)
+        self.prefetcher.start()
+
+    def close(self):
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     #### Methods related to target network update
 
     def update_params(self):
@@ -2,7 +2,10 @@ from fasterrl.agents.base_agent import ValueBasedAgent
 from fasterrl.common.network import *
 from fasterrl.common.buffer import *
 from fasterrl.common.multiagent_buffer import *
+from fasterrl.common.prefetcher import *
+from fasterrl.common.shared_buffer import *
 
+import os
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -10,6 +13,8 @@ import numpy as np
 
 class DQN(ValueBasedAgent):
 
+    vectorized = True
+
     def __init__(self, params):
         super(DQN, self).__init__(params)
 
@@ -26,6 +31,74 @@ class DQN(ValueBasedAgent):
         if "REPLAY_BATCH_SIZE" in params:
             self.replay_batch_size = params["REPLAY_BATCH_SIZE"]
 
+        # copies of the environment stepped at once, with actions for all selected in a single forward pass
+        self.num_envs = 1
+        if "NUM_ENVS" in params:
+            self.num_envs = params["NUM_ENVS"]
+
+        # gradient updates per experience collected. fractions are carried to the next steps
+        self.update_to_data_ratio = 1.0
+        if "UPDATE_TO_DATA_RATIO" in params:
+            self.update_to_data_ratio = params["UPDATE_TO_DATA_RATIO"]
+        self.pending_updates = 0.0
+
+        # how experiences are kept in the replay buffer
+        # deque: list of experience tuples; array: preallocated columnar arrays
+        # memmap: columnar arrays in files under FASTERRL_LOGDIR, for buffers that do not fit in memory
+        # frames: stacked observations kept as single frames, each stored once
+        self.buffer_storage = "deque"
+        if "BUFFER_STORAGE" in params:
+            self.buffer_storage = params["BUFFER_STORAGE"]
+
+        # type of the states in columnar storages, as "float32". None keeps the type of the observations
+        self.buffer_state_dtype = None
+        if "BUFFER_STATE_DTYPE" in params:
+            self.buffer_state_dtype = params["BUFFER_STATE_DTYPE"]
+
+        if self.buffer_storage == "memmap":
+            # folder name inside FASTERRL_LOGDIR/buffers, with one subfolder per trial and agent.
+            # the experiment id if None, so different runs never share files
+            self.buffer_memmap_name = None
+            if "BUFFER_MEMMAP_NAME" in params:
+                self.buffer_memmap_name = params["BUFFER_MEMMAP_NAME"]
+            # reopen files left by a previous run with the same BUFFER_MEMMAP_NAME, instead of starting from an empty buffer
+            self.buffer_memmap_reopen = False
+            if "BUFFER_MEMMAP_REOPEN" in params:
+                self.buffer_memmap_reopen = params["BUFFER_MEMMAP_REOPEN"]
+
+        # pool of experiences shared with other agents, given by the experiment with set_shared_pool
+        self.shared_pool = None
+        self.agent_index = 0
+
+        # save the buffer to FASTERRL_LOGDIR/buffers/<name>/trial<trial>/<alias>. None to disable
+        self.buffer_checkpoint_name = None
+        if "BUFFER_CHECKPOINT_NAME" in params:
+            self.buffer_checkpoint_name = params["BUFFER_CHECKPOINT_NAME"]
+        # restore the buffer saved with the same name and trial when the agent is created,
+        # so a run that is restarted does not need to fill the buffer from scratch
+        self.buffer_checkpoint_resume = False
+        if "BUFFER_CHECKPOINT_RESUME" in params:
+            self.buffer_checkpoint_resume = params["BUFFER_CHECKPOINT_RESUME"]
+        # save every given number of finished episodes. buffer is always saved when the agent is closed
+        self.buffer_checkpoint_interval = 0
+        if "BUFFER_CHECKPOINT_INTERVAL" in params:
+            self.buffer_checkpoint_interval = params["BUFFER_CHECKPOINT_INTERVAL"]
+        # map the saved files instead of reading them when restoring
+        self.buffer_checkpoint_mmap = False
+        if "BUFFER_CHECKPOINT_MMAP" in params:
+            self.buffer_checkpoint_mmap = params["BUFFER_CHECKPOINT_MMAP"]
+        self.episodes_since_checkpoint = 0
+
+        # prepare the next minibatches as tensors in a background thread
+        # number of batches prepared ahead of time, 0 to disable
+        self.prefetch_batches = 0
+        if "PREFETCH_BATCHES" in params:
+            self.prefetch_batches = params["PREFETCH_BATCHES"]
+        self.prefetch_pin_memory = False
+        if "PREFETCH_PIN_MEMORY" in params:
+            self.prefetch_pin_memory = params["PREFETCH_PIN_MEMORY"]
+        self.prefetcher = None
+
         # type of network
         self.network_type = SimpleValueNetwork
         if "NETWORK_TYPE" in params:
@@ -74,6 +147,10 @@ class DQN(ValueBasedAgent):
             if "PRIO_REPLAY_BETA_FRAMES" in params:
                 prio_replay_beta_frames = params["PRIO_REPLAY_BETA_FRAMES"]
             self.prio_replay_beta_increase = (1.0 - self.prio_replay_beta) / prio_replay_beta_frames
+            # sum tree makes sampling and priority updates O(log n) in the buffer size
+            self.prio_replay_sum_tree = False
+            if "PRIO_REPLAY_SUM_TREE" in params:
+                self.prio_replay_sum_tree = params["PRIO_REPLAY_SUM_TREE"]
 
         # add focused sharing
         self.focused_sharing = False
@@ -86,9 +163,16 @@ class DQN(ValueBasedAgent):
         if "WITH_TILES" in params:
             self.with_tiles = params["WITH_TILES"]
 
+        # occupancy grid keeps only the cells visited. if None, decided by the size of the grid
+        self.sparse_grid = None
+        if "SPARSE_GRID" in params:
+            self.sparse_grid = params["SPARSE_GRID"]
+
     def set_environment(self, env):
         super(DQN, self).set_environment(env)
 
+        self.obs_shape = env.observation_space.shape
+
         # initialize networks
         self.net = self.network_type(env.observation_space.shape, env.action_space.n,
             random_seed=self.random_seed).to(self.device)
@@ -97,18 +181,82 @@ class DQN(ValueBasedAgent):
         self.optimizer = optim.Adam(self.net.parameters(), lr=self.learning_rate)
 
         # initialize experience buffer
+        storage = self.create_buffer_storage()
         if self.prioritized_replay and not self.focused_sharing:
-            self.buffer = PrioReplayBuffer(self.experience_buffer_size, self.prio_replay_alpha)
+            if self.prio_replay_sum_tree:
+                self.buffer = SumTreePrioReplayBuffer(self.experience_buffer_size, self.prio_replay_alpha, storage)
+            else:
+                self.buffer = PrioReplayBuffer(self.experience_buffer_size, self.prio_replay_alpha, storage)
         elif self.focused_sharing:
-            if self.prioritized_replay:
-                self.buffer = PrioExperienceBufferGrid(self.experience_buffer_size, self.prio_replay_alpha)
+            if self.prioritized_replay and self.prio_replay_sum_tree:
+                self.buffer = SumTreePrioExperienceBufferGrid(self.experience_buffer_size, self.prio_replay_alpha, storage)
+            elif self.prioritized_replay:
+                self.buffer = PrioExperienceBufferGrid(self.experience_buffer_size, self.prio_replay_alpha, storage)
             else:
-                self.buffer = ExperienceBufferGrid(self.experience_buffer_size)
+                self.buffer = ExperienceBufferGrid(self.experience_buffer_size, storage)
             # set the grid
-            self.buffer.set_grid(env.state_discretizer, env.action_space.n, self.with_tiles)
+            self.buffer.set_grid(env.state_discretizer, env.action_space.n, self.with_tiles, self.sparse_grid)
+        elif storage is not None:
+            self.buffer = ArrayExperienceBuffer(self.experience_buffer_size, storage)
         else:
             self.buffer = ExperienceBuffer(self.experience_buffer_size)
 
+        # with columnar storage, batches are written into tensors reused at every step
+        self.tensor_sampling = storage is not None
+
+        # restore experiences from a previous run
+        if self.buffer_checkpoint_name is not None and self.buffer_checkpoint_resume:
+            path = self.buffer_checkpoint_path()
+            if os.path.exists(os.path.join(path, "buffer.json")):
+                self.buffer.load(path, self.buffer_checkpoint_mmap)
+
+        # buffer will be sampled from another thread
+        if self.prefetch_batches:
+            self.buffer = SynchronizedBuffer(self.buffer)
+
+    def set_shared_pool(self, pool, agent_index):
+        """ Keep experiences in a pool shared with other agents. Must be called before set_environment """
+
+        self.shared_pool = pool
+        self.agent_index = agent_index
+
+    def create_buffer_storage(self):
+        """ Storage for the replay buffer. None keeps the list based storage """
+
+        # only positions in the pool are kept, experiences are written once for all agents
+        if self.shared_pool is not None:
+            return PoolStorage(self.shared_pool, self.agent_index, self.experience_buffer_size)
+
+        # with float32 states, the type used by the networks, batches are gathered into tensors with no conversion
+        if self.buffer_storage == "array":
+            return ExperienceArray(self.experience_buffer_size, self.buffer_state_dtype)
+        elif self.buffer_storage == "memmap":
+            path = self.local_buffer_path(self.buffer_memmap_name or self.run_id)
+            return MemmapExperienceArray(self.experience_buffer_size, path, self.buffer_memmap_reopen, self.buffer_state_dtype)
+        elif self.buffer_storage == "frames":
+            return FrameExperienceArray(self.experience_buffer_size, self.buffer_state_dtype)
+
+        return None
+
+    def local_buffer_path(self, name):
+        """ Folder for files of the buffer, FASTERRL_LOGDIR/buffers/<name>/trial<trial>/<alias> """
+
+        return os.path.join(os.environ["FASTERRL_LOGDIR"], "buffers", name, "trial" + str(self.trial), self.alias)
+
+    def buffer_checkpoint_path(self):
+
+        return self.local_buffer_path(self.buffer_checkpoint_name)
+
+    def checkpoint_episodes(self, num_episodes):
+        """ Count episodes finished, saving the buffer every BUFFER_CHECKPOINT_INTERVAL episodes """
+
+        if self.buffer_checkpoint_name is None or not self.buffer_checkpoint_interval:
+            return
+
+        self.episodes_since_checkpoint += num_episodes
+        if self.episodes_since_checkpoint >= self.buffer_checkpoint_interval:
+            self.buffer.save(self.buffer_checkpoint_path())
+            self.episodes_since_checkpoint = 0
 
     def fill_buffer(self):
         """ Fill buffer prior to experience """
@@ -119,6 +267,14 @@ class DQN(ValueBasedAgent):
         # run multiple round until buffer is full. access env directly
         while len(self.buffer) < self.replay_batch_size:
 
+            # all copies of a vectorized environment step together
+            if self.num_envs > 1:
+                actions = np.random.randint(self.num_actions, size=self.num_envs)
+                next_states, rewards, dones, info = self.env.step(actions)
+                self.buffer.receive(self.experience_batch(actions, info["final_observations"], rewards, dones))
+                self.state = next_states
+                continue
+
             action = self.env.action_space.sample()
             next_state, reward, done, _ = self.env.step(action)
             self.buffer.append(Experience(self.state, action, reward, done, next_state))
@@ -130,14 +286,56 @@ class DQN(ValueBasedAgent):
             if done:
                 self.reset()
 
+    def play_step(self):
+
+        if self.num_envs == 1:
+            return super(DQN, self).play_step()
+
+        # step all copies. copies that finish an episode are already reset
+        actions = self.select_actions()
+        next_states, rewards, dones, info = self.env.step(actions)
+
+        # experiences end in the last observation of the episode, not in the first of the next one
+        self.learn_batch(actions, info["final_observations"], rewards, dones)
+
+        # prepare for next
+        self.state = next_states
+
+        # bookkeeping, rewards and dones of all copies
+        self.step_reward = rewards
+
+        # moving params follow the number of experiences collected
+        self.update_params(self.num_envs)
+
+        return dones
+
+    def select_actions(self):
+        """ Epsilon greedy actions for all copies of the environment, with a single forward pass """
+
+        explore = np.random.rand(self.num_envs) < self.epsilon
+        actions = np.random.randint(self.num_actions, size=self.num_envs)
+
+        # no forward pass if all copies explore
+        if not explore.all():
+            greedy = ~explore
+            actions[greedy] = self.select_best_actions(self.state[greedy])
+
+        return actions
+
     def select_best_action(self, state):
 
-        q_vals_v = self.calculate_q_vals(state)
+        return int(self.select_best_actions(state)[0])
+
+    def select_best_actions(self, states):
+        """ Greedy action of a state, or of each state in a batch """
+
+        # no gradients are required to act
+        with torch.no_grad():
+            q_vals_v = self.calculate_q_vals(states)
         # chooses greedy action and get its value
         _, act_v = torch.max(q_vals_v, dim=1)
-        action = int(act_v.item())
 
-        return action
+        return act_v.cpu().numpy()
 
     def calculate_q_vals(self, state=None):
 
@@ -145,10 +343,12 @@ class DQN(ValueBasedAgent):
         if state is None:
             state = self.state
 
-        # moves state into an array with 1 sample to pass through neural net
-        state_a = np.array([state], copy=False)
+        # a single state is moved into a batch with 1 sample to pass through neural net
+        state_a = np.asarray(state, dtype=np.float32)
+        if state_a.ndim == len(self.obs_shape):
+            state_a = state_a[np.newaxis]
         # creates tensor
-        state_v = torch.FloatTensor(state_a).to(self.device)
+        state_v = torch.from_numpy(state_a).to(self.device)
         # get q values with feed forward
         q_vals_v = self.net(state_v)
 
@@ -159,24 +359,62 @@ class DQN(ValueBasedAgent):
         # append experience to buffer
         exp = Experience(self.state, action, reward, done, next_state)
         self.buffer.append(exp)
+        if done:
+            self.checkpoint_episodes(1)
+
+        self.learn_from_buffer(1, action, next_state, reward, done)
+
+    def learn_batch(self, actions, next_states, rewards, dones):
+        """ Learn from the experiences of all copies of the environment, added to the buffer at once """
+
+        self.buffer.receive(self.experience_batch(actions, next_states, rewards, dones))
+        self.checkpoint_episodes(int(np.sum(dones)))
+
+        self.learn_from_buffer(self.num_envs, actions, next_states, rewards, dones)
+
+    def experience_batch(self, actions, next_states, rewards, dones):
+        """ Experiences of all copies from the current states, as one array per field """
+
+        return Experience(np.asarray(self.state), np.asarray(actions), np.asarray(rewards, dtype=np.float32),
+            np.asarray(dones, dtype=np.uint8), np.asarray(next_states))
+
+    def learn_from_buffer(self, num_experiences, action, next_state, reward, done):
+        """ Run the gradient updates due for the experiences added, according to the update to data ratio """
 
         ## learn when there are enough batch samples
         ## ideally I should accumulate a mass of experiences before starting to learn
         if len(self.buffer) > self.replay_batch_size:
-            # different type of learning depending on using or not priorities
-            if self.prioritized_replay:
-                self.batch_learn_with_priorities(action, next_state, reward, done)
-            else:
-                self.batch_learn(action, next_state, reward, done)
+            self.pending_updates += num_experiences * self.update_to_data_ratio
+            while self.pending_updates >= 1:
+                self.pending_updates -= 1
+                self.train_step(action, next_state, reward, done)
+
+    def train_step(self, action=None, next_state=None, reward=None, done=None):
+        """ A single gradient update, on a batch sampled from the buffer. Requires enough experiences in the buffer """
+
+        # start preparing batches once there are enough samples
+        if self.prefetch_batches and self.prefetcher is None:
+            self.start_prefetcher()
+
+        # different type of learning depending on using or not priorities
+        if self.prioritized_replay:
+            self.batch_learn_with_priorities(action, next_state, reward, done)
+        else:
+            self.batch_learn(action, next_state, reward, done)
 
     def batch_learn(self, action, next_state, reward, done):
 
         # zero gradients
         self.optimizer.zero_grad()
-        # sample from buffer
-        batch = self.buffer.sample(self.replay_batch_size)
+        # sample from buffer, or get the batch prepared in the background
+        if self.prefetcher is not None:
+            batch_v = self.prefetcher.get().tensors
+        elif self.tensor_sampling:
+            batch_v = self.unpack_tensors(self.buffer.sample_tensors(self.replay_batch_size, self.device))
+        else:
+            batch_v = self.unpack_batch(self.buffer.sample(self.replay_batch_size))
         # calculate loss
-        loss_t = self.calc_loss(batch)
+        loss_t = self.calc_loss(batch_v)
         # calculate gradients
         loss_t.backward()
         # gradient clipping
@@ -189,10 +427,22 @@ class DQN(ValueBasedAgent):
 
         # zero gradients
         self.optimizer.zero_grad()
-        # sample from buffer
-        batch, batch_indices, batch_weights = self.buffer.sample(self.replay_batch_size, self.prio_replay_beta)
+        # sample from buffer, or get the batch prepared in the background
+        if self.prefetcher is not None:
+            prefetched = self.prefetcher.get()
+            batch_v, batch_weights_v = prefetched.tensors, prefetched.weights_v
+        elif self.tensor_sampling:
+            batch_v, batch_indices, batch_weights = \
+                self.buffer.sample_tensors(self.replay_batch_size, self.prio_replay_beta, self.device)
+            batch_v = self.unpack_tensors(batch_v)
+            batch_weights_v = torch.from_numpy(batch_weights).to(self.device)
+        else:
+            batch, batch_indices, batch_weights = self.buffer.sample(self.replay_batch_size, self.prio_replay_beta)
+            batch_v = self.unpack_batch(batch)
+            # batch weights are importance sampling weights
+            batch_weights_v = torch.tensor(batch_weights).to(self.device)
         # calculate loss
-        loss_v, sample_prios_v = self.calc_loss_with_priorities(batch, batch_weights)
+        loss_v, sample_prios_v = self.calc_loss_with_priorities(batch_v, batch_weights_v)
         # calculate gradients
         loss_v.backward()
         # gradient clipping
@@ -200,66 +450,113 @@ class DQN(ValueBasedAgent):
             nn.utils.clip_grad_norm_(self.net.parameters(), self.grad_l2_clip)
         # optimize
         self.optimizer.step()
-        # update priorities on buffer
-        self.buffer.update_priorities(batch_indices, sample_prios_v.data.cpu().numpy())
+        # update priorities on buffer, buffer takes the tensor directly
+        if self.prefetcher is not None:
+            self.prefetcher.update_priorities(prefetched, sample_prios_v.detach())
+        else:
+            self.buffer.update_priorities(batch_indices, sample_prios_v.detach())
+
+    def start_prefetcher(self):
+        """ Start preparing batches in a background thread """
+
+        # with pinned memory, tensors are created in cpu and copied asynchronously by the prefetcher
+        prepare = self.unpack_batch
+        if self.prefetch_pin_memory:
+            prepare = lambda batch: self.unpack_batch(batch, device=torch.device("cpu"))
+
+        beta = None
+        if self.prioritized_replay:
+            beta = lambda: self.prio_replay_beta
+
+        self.prefetcher = BatchPrefetcher(self.buffer, self.replay_batch_size, prepare,
+            self.prefetch_batches, self.device, self.prefetch_pin_memory, beta)
+        self.prefetcher.start()
+
+    def close(self):
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+        if self.buffer_checkpoint_name is not None:
+            self.buffer.save(self.buffer_checkpoint_path())
 
 
-    def update_params(self):
-        super(DQN, self).update_params()
+    def update_params(self, frames=1):
+        """ Advance moving params by a number of frames, one per experience collected """
+
+        for _ in range(frames):
+            super(DQN, self).update_params()
 
         # merge network and target network according to specified strategy
         if self.soft_update:
-            self.soft_update_target_network()
+            # same as one soft update per frame
+            self.soft_update_target_network(1 - (1 - self.soft_update_tau) ** frames)
         else:
-            self.frame_count += 1
-            if self.frame_count == self.sync_target_frames:
+            self.frame_count += frames
+            if self.frame_count >= self.sync_target_frames:
                 self.hard_update_target_network()
                 self.frame_count = 0
 
         # update beta
         if self.prioritized_replay:
-            self.prio_replay_beta += self.prio_replay_beta_increase
+            self.prio_replay_beta += self.prio_replay_beta_increase * frames
 
     def hard_update_target_network(self):
         """ Update every X steps """
 
         self.tgt_net.load_state_dict(self.net.state_dict())
 
-    def soft_update_target_network(self):
+    def soft_update_target_network(self, tau=None):
         """Soft update model parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
         Params
         ======
             local_model (PyTorch model): weights will be copied from
             target_model (PyTorch model): weights will be copied to
-            tau (float): interpolation parameter
+            tau (float): interpolation parameter, soft_update_tau by default
         """
 
+        if tau is None:
+            tau = self.soft_update_tau
+
         # iterate through both together and make a copy one by one
         for target_param, local_param in zip(self.tgt_net.parameters(), self.net.parameters()):
             target_param.data.copy_(
-                self.soft_update_tau*local_param.data + (1-self.soft_update_tau)*target_param.data
+                tau*local_param.data + (1-tau)*target_param.data
             )
 
-    def unpack_batch(self, batch):
+    def unpack_batch(self, batch, device=None):
 
         states, actions, rewards, dones, next_states = batch
 
+        if device is None:
+            device = self.device
+
         # creates tensors. and push them to device, if GPU is available, then uses GPU
-        states_v = torch.FloatTensor(states).to(self.device)
-        next_states_v = torch.FloatTensor(next_states).to(self.device)
+        states_v = torch.FloatTensor(states).to(device)
+        next_states_v = torch.FloatTensor(next_states).to(device)
         # force float if reward is int
-        rewards_v = torch.FloatTensor(rewards).to(self.device)
-        actions_v = torch.tensor(actions).to(self.device)
-        done_mask = torch.ByteTensor(dones).to(self.device)
+        rewards_v = torch.FloatTensor(rewards).to(device)
+        actions_v = torch.tensor(actions).to(device)
+        # bool mask, used to index next state values
+        done_mask = torch.as_tensor(dones, dtype=torch.bool).to(device)
 
         return states_v, next_states_v, rewards_v, actions_v, done_mask
 
-    def calc_loss(self, batch):
+    def unpack_tensors(self, batch_v):
+        """ Reorder tensors sampled from the buffer to the order returned by unpack_batch """
+
+        states_v, actions_v, rewards_v, done_mask, next_states_v = batch_v
+
+        # states kept in other types, such as uint8 frames, are converted for the networks
+        return states_v.float(), next_states_v.float(), rewards_v, actions_v, done_mask
+
+    def calc_loss(self, batch_v):
         """ Function optimized to exploit GPU parallelism by processing all batch samples with vector operations """
 
-        # unpack vectors of variables
-        states_v, next_states_v, rewards_v, actions_v, done_mask = self.unpack_batch(batch)
+        # unpack vectors of variables, already converted to tensors
+        states_v, next_states_v, rewards_v, actions_v, done_mask = batch_v
 
         # calculate state-action values
         # gather: select only the values for the actions taken
@@ -294,11 +591,9 @@ class DQN(ValueBasedAgent):
 
         return loss
 
-    def calc_loss_with_priorities(self, batch, batch_weights):
+    def calc_loss_with_priorities(self, batch_v, batch_weights_v):
 
-        states_v, next_states_v, rewards_v, actions_v, done_mask = self.unpack_batch(batch)
-        # batch weights are importance sampling weights
-        batch_weights_v = torch.tensor(batch_weights).to(self.device)
+        states_v, next_states_v, rewards_v, actions_v, done_mask = batch_v
 
         # calculate state action values
         state_action_values = self.net(states_v).gather(1, actions_v.unsqueeze(-1)).squeeze(-1)
@@ -335,6 +630,30 @@ class DQN(ValueBasedAgent):
         return losses_v.mean(), losses_v + 1e-5
 
 
+class DQNActor(DQN):
+    """ Acting part of DQN, run by the actor processes of an actor-learner experiment.
+
+        Keeps only the network, with weights synced from the learner. There is no buffer, target network or optimizer
+    """
+
+    def set_environment(self, env):
+        # skips the buffer and networks of the learner
+        super(DQN, self).set_environment(env)
+
+        self.obs_shape = env.observation_space.shape
+        self.net = self.network_type(env.observation_space.shape, env.action_space.n,
+            random_seed=self.random_seed).to(self.device)
+
+    def update_params(self, frames=1):
+        """ Only epsilon moves in actors """
+
+        for _ in range(frames):
+            super(DQN, self).update_params()
+
+    def close(self):
+        pass
+
+
 """
 TODO:
 see if I can move everythin related to torch to network
@@ -343,4 +662,3 @@ want to make a test replacing it for a tensorflow network
 this should include the soft and hard updates, and the gradient clipping
 
 """
-
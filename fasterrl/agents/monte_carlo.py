@@ -1,5 +1,7 @@
 from fasterrl.agents.td_learning import TDLearning
 from fasterrl.common.buffer import MCTransitionBuffer
+from fasterrl.common.exploration import greedy_probabilities
+import numpy as np
 
 class MonteCarlo(TDLearning):
 
@@ -12,12 +14,15 @@ class MonteCarlo(TDLearning):
     def set_environment(self, env):
         super(MonteCarlo, self).set_environment(env)
 
-        # include a count for each state action pair
-        self.qcount = {}
-        for state in range(self.env.observation_space.n):
-            self.qcount[state] = {}
-            for action in range(self.env.action_space.n):
-                self.qcount[state][action] = 0
+        # include a count for each state action pair, same shape as the q-table
+        # weighted by importance sampling, so not restricted to integers
+        self.qcount = np.zeros_like(self.qtable)
+
+    def remap_qtable(self, var_maps):
+        super(MonteCarlo, self).remap_qtable(var_maps)
+
+        # counts follow the q-values to the new bins
+        self.qcount = self.remap_table(self.qcount, var_maps)
 
     def learn(self, action, next_state, reward, done):
 
@@ -26,12 +31,30 @@ class MonteCarlo(TDLearning):
             if self.importance_sampling:
                 self.learn_with_importance_sampling(action, next_state, reward, done)
             else:
-                for state, action, value in self.buffer.calculate_value(self.gamma):
-                    error = value - self.qtable[state][action]
-                    # will need to change how is this update in monte carlo
-                    # to account for discretization
-                    self.qcount[state][action] += 1
-                    self.qtable[state][action] += error/self.qcount[state][action]
+                self.learn_episode()
+
+    def learn_episode(self):
+        """ Update the average return of all states and actions visited in the episode at once """
+
+        _, states, actions, returns = self.buffer.episode(self.gamma)
+        if len(actions) == 0:
+            return
+
+        # position of each state and action in the flattened q-table
+        if states.ndim == 1:
+            index = (states, actions)
+        else:
+            index = tuple(states.T) + (actions,)
+        cells = np.ravel_multi_index(index, self.qtable.shape)
+
+        # repeated visits in the episode are added together, same as updating the average once for each
+        cells, inverse, visits = np.unique(cells, return_inverse=True, return_counts=True)
+        returns_sum = np.bincount(inverse, weights=returns)
+
+        qtable = self.qtable.reshape(-1)
+        qcount = self.qcount.reshape(-1)
+        qcount[cells] += visits
+        qtable[cells] += (returns_sum - visits * qtable[cells]) / qcount[cells]
 
     def learn_with_importance_sampling(self, action, next_state, reward, done):
         """ An incremental implementation of Monte-Carlo importance sampling
@@ -56,15 +79,8 @@ class MonteCarlo(TDLearning):
 
 
         # calculate probability in target policy
-        sorted_actions = sorted(self.qtable[state].items(), key=lambda x:-x[1])
-        max_value = sorted_actions[0][1] # first of the list, get_value
-        best_actions_values = filter(lambda x:x[1]==max_value, sorted_actions)
-        best_actions = list(map(lambda x:x[0], best_actions_values))
-        if action in best_actions:
-            # need to account for cases where ties are randomly broken
-            prob_greedy = 1/(len(best_actions))
-        else:
-            prob_greedy = 0
+        # need to account for cases where ties are randomly broken
+        prob_greedy = greedy_probabilities(self.get_qvalues(state))[action]
 
         # calculate probability in behavior policy
         prob_exploration = self.epsilon/self.num_actions + (1-self.epsilon) * prob_greedy
@@ -1,5 +1,6 @@
 from fasterrl.agents.base_agent import ValueBasedAgent
 from fasterrl.common.buffer import TransitionBuffer, Experience
+from fasterrl.common.exploration import greedy_action, greedy_probabilities
 import numpy as np
 from time import sleep
 
@@ -29,6 +30,16 @@ class TDLearning(ValueBasedAgent):
         if "WITH_TILES" in params:
             self.with_tiles = params["WITH_TILES"]
 
+        # states as a single int id, one per tile, allow a single index in the q-table for all tiles
+        self.flat_states = False
+        if "DISCRETIZE_STATE_FLAT" in params:
+            self.flat_states = params["DISCRETIZE_STATE_FLAT"]
+
+        # hashed tiles share a single table of fixed size, indexed by the hash of each tile
+        self.tile_hash_size = None
+        if "TILE_HASH_SIZE" in params:
+            self.tile_hash_size = params["TILE_HASH_SIZE"]
+
     def set_environment(self, env):
         super(TDLearning, self).set_environment(env)
 
@@ -47,18 +58,49 @@ class TDLearning(ValueBasedAgent):
             self.num_actions = env.action_space.n
 
         # initialize q-table
-        if self.with_tiles:
+        if self.with_tiles and self.tile_hash_size:
+            # weights of all tiles, with one column per action
+            self.qtable = np.zeros(shape=(self.tile_hash_size, )+self.action_size)
+
+        elif self.with_tiles:
             # add tiles in the last dimensions
             num_tiles = env.state_discretizer.tiles_count()
             self.qtable = np.zeros(shape=(num_tiles, )+self.obs_size+self.action_size)
+            self.tile_index = np.arange(num_tiles)
 
         else:
             self.qtable = np.zeros(shape=self.obs_size+self.action_size)
 
         # also need to review the other implementations inheriting from this class
 
+        # bins of online discretizers are refit during training, q-values follow the states to the new bins
+        if getattr(env, "state_discretizer", None) is not None:
+            env.state_discretizer.add_refit_listener(self.remap_qtable)
+
+    def remap_qtable(self, var_maps):
+        """ Move q-values to the bins of the discretizer after a refit """
+
+        self.qtable = self.remap_table(self.qtable, var_maps)
+
+    def remap_table(self, table, var_maps):
+        """ Move the entries of a table with the shape of the q-table to the bins after a refit """
+
+        # hashed tiles mix all states in the table, so weights are kept as they are
+        if self.with_tiles and self.tile_hash_size:
+            return table
+
+        # with tiles, states start in the second dimension of the q-table
+        axis = 1 if self.with_tiles else 0
+        return self.env.state_discretizer.remap_states(table, var_maps, axis)
+
     def get_qvalues(self, state):
-        if self.with_tiles:
+        if self.with_tiles and self.tile_hash_size:
+            # hashed state has the index of each tile in the table
+            return self.qtable[state, :].mean(axis=0)
+        elif self.with_tiles and self.flat_states:
+            # flat state has one id per tile
+            return self.qtable[self.tile_index, state].mean(axis=0)
+        elif self.with_tiles:
             qvalues = []
             for idx, s in enumerate(state):
                 qvalues.append(self.qtable[idx][s])
@@ -68,7 +110,11 @@ class TDLearning(ValueBasedAgent):
             return self.qtable[state]
 
     def get_qvalue(self, state, action):
-        if self.with_tiles:
+        if self.with_tiles and self.tile_hash_size:
+            return self.qtable[state, action].mean()
+        elif self.with_tiles and self.flat_states:
+            return self.qtable[self.tile_index, state, action].mean()
+        elif self.with_tiles:
             qvalue = []
             for idx, s in enumerate(state):
                 qvalue.append(self.qtable[idx][s][action])
@@ -80,7 +126,13 @@ class TDLearning(ValueBasedAgent):
     def update_qvalue(self, state, action, step_value):
         # method with no return
 
-        if self.with_tiles:
+        if self.with_tiles and self.tile_hash_size:
+            # tiles may collide in the table, so updates are added once for each tile
+            np.add.at(self.qtable[:, action], list(state), step_value)
+        elif self.with_tiles and self.flat_states:
+            # tiles are all different, so each state is updated once
+            self.qtable[self.tile_index, state, action] += step_value
+        elif self.with_tiles:
             for idx, s in enumerate(state):
                 self.qtable[idx][s][action] = self.qtable[idx][s][action] + step_value
         else:
@@ -88,14 +140,8 @@ class TDLearning(ValueBasedAgent):
 
     def select_best_action(self, state):
 
-        # select all possible actions
-        possible_actions = list(enumerate(self.get_qvalues(state)))
-        # shuffle before sorting, to ensure randomness in case of tie
-        np.random.shuffle(possible_actions)
-        # sort and get first - can also use argmax
-        action = sorted(possible_actions, key=lambda x:-x[1])[0][0]
-
-        return action
+        # argmax, with ties broken at random
+        return greedy_action(self.get_qvalues(state))
 
     def select_next_action(self, next_state):
 
@@ -200,7 +246,7 @@ class NStepsTDLearning(TDLearning):
             imp_samp = self.step_importance_sampling(t.state, t.action)
             importance_sampling_v.append(imp_samp)
 
-        importance_sampling = np.product(importance_sampling_v)
+        importance_sampling = np.prod(importance_sampling_v)
 
         return importance_sampling
 
@@ -210,15 +256,8 @@ class NStepsTDLearning(TDLearning):
         """
 
         # calculate probability in target policy
-        sorted_actions = sorted(self.get_qvalues(state).items(), key=lambda x:-x[1])
-        max_value = sorted_actions[0][1] # first of the list, get_value
-        best_actions_values = filter(lambda x:x[1]==max_value, sorted_actions)
-        best_actions = list(map(lambda x:x[0], best_actions_values))
-        if action in best_actions:
-            # need to account for cases where ties are randomly broken
-            prob_greedy = 1/(len(best_actions))
-        else:
-            prob_greedy = 0
+        # need to account for cases where ties are randomly broken
+        prob_greedy = greedy_probabilities(self.get_qvalues(state))[action]
 
         # calculate probability in behavior policy
         prob_exploration = self.epsilon/self.num_actions + (1-self.epsilon) * prob_greedy
@@ -0,0 +1,155 @@
+"""
+    Actor processes for DQN: acting in their own environments with copies of the network synced from the learner
+
+"""
+
+import copy
+from queue import Empty, Full
+
+import numpy as np
+import torch
+
+from fasterrl.agents.dqn import DQNActor
+from fasterrl.common.buffer import Experience, experience_columns
+from fasterrl.common.environment import BaseEnv
+
+__all__ = [
+    "SharedWeights",
+    "run_actor",
+    "put_until_stopped",
+    "get_available",
+    "check_actors"
+]
+
+
+class SharedWeights:
+    """ Copy of the weights of a network in shared memory, published by the learner and read by the actors.
+
+        A version number, increased at every publication, lets actors skip copies of weights they already have
+    """
+
+    def __init__(self, net, context):
+
+        # weights are always shared from cpu, actors act in cpu
+        self.net = copy.deepcopy(net).cpu()
+        self.net.share_memory()
+        self.version = context.Value("l", 0)
+
+    def publish(self, net):
+
+        with self.version.get_lock():
+            self.net.load_state_dict(net.state_dict())
+            self.version.value += 1
+
+    def pull(self, net, version):
+        """ Copy the weights into net, if newer than version. Returns the version of the weights in net """
+
+        if self.version.value == version:
+            return version
+
+        with self.version.get_lock():
+            net.load_state_dict(self.net.state_dict())
+            return self.version.value
+
+
+def put_until_stopped(queue, item, stop):
+    """ Put an item in a bounded queue, waiting while it is full. Returns False if stopped before it was put """
+
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+
+    return False
+
+
+def get_available(queue, wait=False, timeout=0.1):
+    """ All items in a queue, without blocking. If wait, waits up to timeout for the first item """
+
+    items = []
+    if wait:
+        try:
+            items.append(queue.get(timeout=timeout))
+        except Empty:
+            return items
+
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+
+def check_actors(actors):
+    """ Raise if an actor process has exited. Actors only exit once stopped, any earlier exit is a failure """
+
+    for actor_index, actor in enumerate(actors):
+        if actor.exitcode is not None:
+            raise Exception("Actor {} exited with code {} before the end of the trial".format(actor_index, actor.exitcode))
+
+
+def run_actor(params, actor_index, weights, transitions, episodes, stop):
+    """ Loop of an actor process.
+
+        Plays its own environment with epsilon greedy actions and sends the experiences to the learner in chunks,
+        as one array per field. The transitions queue is bounded, so actors wait when the learner falls behind.
+        Weights are pulled from the learner every ACTOR_SYNC_STEPS steps. Finished episodes are sent as
+        (actor_index, reward, steps), with the reward in the original scale
+    """
+
+    chunk_size = 64
+    if "ACTOR_CHUNK_SIZE" in params:
+        chunk_size = params["ACTOR_CHUNK_SIZE"]
+
+    sync_steps = 400
+    if "ACTOR_SYNC_STEPS" in params:
+        sync_steps = params["ACTOR_SYNC_STEPS"]
+
+    # actors share the cores, one thread each. forked actors would otherwise share the random state
+    torch.set_num_threads(1)
+    np.random.seed()
+
+    # learner may use a gpu, actors act in cpu, in a single environment each
+    params = dict(params, DEVICE="cpu", NUM_ENVS=1)
+    env = BaseEnv(params)
+    agent = DQNActor(params)
+    agent.set_environment(env)
+    version = weights.pull(agent.net, -1)
+
+    # items left in the queue are dropped when the process exits, the learner stops reading first
+    transitions.cancel_join_thread()
+    episodes.cancel_join_thread()
+
+    agent.reset()
+    chunk = []
+    episode_reward, episode_steps = 0, 0
+    steps = 0
+    while not stop.is_set():
+
+        action = agent.select_action()
+        next_state, reward, done, _ = env.step(action)
+        chunk.append(Experience(agent.state, action, reward, done, next_state))
+
+        # prepare for next
+        agent.state = next_state
+        agent.update_params()
+        steps += 1
+
+        # bookkeeping
+        episode_reward += reward
+        episode_steps += 1
+        if done:
+            if env.reward_scaling_factor:
+                episode_reward /= env.reward_scaling_factor
+            episodes.put((actor_index, episode_reward, episode_steps))
+            episode_reward, episode_steps = 0, 0
+            agent.reset()
+
+        if len(chunk) == chunk_size:
+            put_until_stopped(transitions, experience_columns(chunk), stop)
+            chunk = []
+
+        if steps % sync_steps == 0:
+            version = weights.pull(agent.net, version)
@@ -1,4 +1,7 @@
+import os
+import json
 import numpy as np
+import torch
 from collections import namedtuple, deque
 from functools import reduce
 
@@ -10,8 +13,16 @@ __all__ = [
     "TransitionBuffer",
     "MCTransitionBuffer",
     "ExperienceBuffer",
+    "ExperienceArray",
+    "MemmapExperienceArray",
+    "FrameExperienceArray",
+    "ArrayExperienceBuffer",
     "EpisodeBuffer",
-    "PrioReplayBuffer"
+    "PrioReplayBuffer",
+    "SegmentTree",
+    "SumSegmentTree",
+    "MinSegmentTree",
+    "SumTreePrioReplayBuffer"
 ]
 
 # need to better organize this log of experience, transition, etc
@@ -28,6 +39,131 @@ ShortExperience = namedtuple('ShortExperience',
 Episode = namedtuple('Episode',
     field_names=['reward', 'experiences'])
 
+# fields saved for each experience in checkpoints, in the order of Experience
+EXPERIENCE_COLUMNS = ["states", "actions", "rewards", "dones", "next_states"]
+
+# arrays saved by FrameExperienceArray, besides the list of free frames
+FRAME_ARRAYS = ["actions", "rewards", "dones", "state_refs", "next_state_refs", "frames", "frame_refcount"]
+
+# arrays are written and copied in chunks of about this size, so large buffers are never duplicated in memory
+CHECKPOINT_CHUNK_BYTES = 64 * 2 ** 20
+
+
+def is_columns(experiences):
+    """ Batches are either lists of experiences, or one array per field as returned by sample """
+
+    return len(experiences) == len(Experience._fields) and isinstance(experiences[0], np.ndarray)
+
+def batch_length(experiences):
+    """ Number of experiences in a batch, in either format """
+
+    return len(experiences[0]) if is_columns(experiences) else len(experiences)
+
+def discounted_returns(rewards, gamma):
+    """ Discounted return from each step of an episode, as a reverse cumulative sum of the rewards.
+
+        Rewards are scaled by the discount from the start of a chunk, summed, and scaled back.
+        Chunks are short enough that the discount doesn't vanish, and the return of each chunk is carried to the previous one
+    """
+
+    rewards = np.asarray(rewards, dtype=np.float64)
+    returns = np.zeros(len(rewards))
+    if gamma <= 0:
+        returns[:] = rewards
+        return returns
+
+    chunk = len(rewards) if gamma >= 1 else max(1, int(np.log(1e-100) / np.log(gamma)))
+    value = 0.
+    for end in range(len(rewards), 0, -chunk):
+        start = max(0, end - chunk)
+        discounts = gamma ** np.arange(end - start)
+        discounted = np.cumsum((discounts * rewards[start:end])[::-1])[::-1] / discounts
+        # return after the chunk, discounted back to each step
+        returns[start:end] = discounted + gamma ** np.arange(end - start, 0, -1) * value
+        value = returns[start]
+
+    return returns
+
+def slice_batch(experiences, start, end):
+    """ Experiences of a batch between two positions, in the same format """
+
+    if is_columns(experiences):
+        return tuple(values[start:end] for values in experiences)
+
+    return experiences[start:end]
+
+def experience_columns(experiences):
+    """ Convert a batch to one array per field, with the types returned by sample """
+
+    if is_columns(experiences):
+        return experiences
+
+    states, actions, rewards, dones, next_states = zip(*experiences)
+    return np.array(states), np.array(actions), np.array(rewards, dtype=np.float32), \
+        np.array(dones, dtype=np.uint8), np.array(next_states)
+
+def experience_list(experiences):
+    """ Convert a batch to a list of experiences """
+
+    if is_columns(experiences):
+        return [Experience(*values) for values in zip(*experiences)]
+
+    return list(experiences)
+
+def chunk_rows(row_bytes):
+    """ Number of rows that fit in a chunk """
+
+    return max(1, CHECKPOINT_CHUNK_BYTES // max(1, row_bytes))
+
+def write_array(path, name, array):
+    """ Write an array to <name>.npy in the folder, one chunk at a time """
+
+    array = np.asarray(array)
+    file_path = os.path.join(path, name + ".npy")
+    if array.ndim == 0 or array.size == 0:
+        np.save(file_path, array)
+        return
+
+    out = np.lib.format.open_memmap(file_path, mode="w+", dtype=array.dtype, shape=array.shape)
+    rows = chunk_rows(array[:1].nbytes)
+    for start in range(0, len(array), rows):
+        out[start:start + rows] = array[start:start + rows]
+    out.flush()
+    del out
+
+def write_batches(path, names, take, size):
+    """ Write the batches returned by take, one .npy file per field. Used for storages with no columns """
+
+    outs = None
+    start, rows = 0, 1
+    while start < size:
+        batch = take(np.arange(start, min(start + rows, size)))
+        # files are created with the shapes and types of the first batch
+        if outs is None:
+            outs = [np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+",
+                dtype=values.dtype, shape=(size,) + values.shape[1:]) for name, values in zip(names, batch)]
+            rows = chunk_rows(sum(values[:1].nbytes for values in batch))
+        for out, values in zip(outs, batch):
+            out[start:start + len(values)] = values
+        start += len(batch[0])
+
+    for out in outs or []:
+        out.flush()
+
+def read_arrays(path, names, mmap=False):
+    """ Read arrays saved with write_array. With mmap, files are mapped copy-on-write and read on demand """
+
+    mmap_mode = "c" if mmap else None
+    return [np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in names]
+
+def copy_rows(out, values):
+    """ Copy values into the first rows of out, one chunk at a time """
+
+    rows = chunk_rows(values[:1].nbytes)
+    for start in range(0, len(values), rows):
+        chunk = values[start:start + rows]
+        out[start:start + len(chunk)] = chunk
+
 
 # will do separate classes then merge if I see opportunity to merge
 
@@ -76,74 +212,772 @@ class MCTransitionBuffer:
     def append(self, transition):
         self.buffer.append(transition)
 
-    def calculate_value(self, gamma):
-        """ Calculate value according to some pre-specified n-step """
+    def episode(self, gamma):
+        """ Values of the transitions, computed for the whole episode at once.
 
-        if not self.first_visit:
-            value = 0
-            for state, action, reward in self.buffer[::-1]:
-                value = reward + gamma * value
-                yield state, action, value
+            Returns the positions of the transitions, the states and actions as arrays, and the return from each.
+            With first visit, only the first occurrence of each state and action is kept
+        """
 
-        else:
-            # identify which states are first visit
-            visited_states = set()
-            first_visits = []
-            for state, action, reward in  self.buffer[::-1]:
-                if (state, action) not in visited_states:
-                    visited_states.add((state, action))
-                    first_visits.append(True)
-                else:
-                    first_visits.append(False)
+        states = np.array([t[0] for t in self.buffer])
+        actions = np.array([t[1] for t in self.buffer], dtype=np.int64)
+        returns = discounted_returns([t[2] for t in self.buffer], gamma)
+        positions = np.arange(len(self.buffer))
+
+        if self.first_visit and len(self.buffer) > 0:
+            # state and action as a single row, the first occurrence of each row is its first visit
+            pairs = np.column_stack([states.reshape(len(states), -1), actions])
+            _, first = np.unique(pairs, axis=0, return_index=True)
+            positions = np.sort(first)
 
-            # yield only if first visit
-            value = 0
-            for (state, action, reward), fv in reversed(list(zip(self.buffer, first_visits))):
-                value = reward + gamma * value
-                if fv:
-                    yield state, action, value
+        return positions, states[positions], actions[positions], returns[positions]
+
+    def calculate_value(self, gamma):
+        """ Calculate value according to some pre-specified n-step """
+
+        # transitions are yielded from the last one, with the original states
+        positions, _, actions, returns = self.episode(gamma)
+        for position, action, value in zip(positions[::-1], actions[::-1].tolist(), returns[::-1].tolist()):
+            yield self.buffer[position][0], action, value
 
 class ExperienceBuffer:
 
     def __init__(self, capacity):
         # initializes a deque
         self.buffer = deque(maxlen=capacity)
+        self.capacity = capacity
 
     def __len__(self):
         return len(self.buffer)
 
     def receive(self, experiences):
-        """ Receive and append a batch of experience. """
+        """ Receive and append a batch of experience, either a list of experiences or one array per field """
+
+        for part in self.batch_parts(experiences):
+            self.write_batch(part)
 
-        for experience in experiences:
-            self.append(experience)
+    def batch_parts(self, experiences):
+        """ Split a batch in parts no larger than the buffer, written one after the other.
+
+            Experiences that the same batch would overwrite are skipped, moving the position as appending them would
+        """
+
+        size = batch_length(experiences)
+        if isinstance(self.buffer, deque) or size <= self.capacity:
+            yield experiences
+            return
+
+        # fill the buffer first
+        free = self.capacity - len(self.buffer)
+        if free > 0:
+            yield slice_batch(experiences, 0, free)
+            experiences = slice_batch(experiences, free, size)
+            size -= free
+
+        if size > self.capacity:
+            self.pos = (self.pos + size - self.capacity) % self.capacity
+            experiences = slice_batch(experiences, size - self.capacity, size)
+
+        yield experiences
+
+    def write_batch(self, experiences):
+        """ Write a batch no larger than the buffer at the current position of the ring,
+            in at most two contiguous slices. Returns the positions written
+        """
+
+        # deque has no positions, it only drops the oldest experiences
+        if isinstance(self.buffer, deque):
+            self.buffer.extend(experience_list(experiences))
+            return None
+
+        size = batch_length(experiences)
+        positions = (self.pos + np.arange(size)) % self.capacity
+        if size == 0:
+            return positions
+
+        if hasattr(self.buffer, "write"):
+            # columnar storages write one slice per field
+            columns = experience_columns(experiences)
+            first = min(size, self.capacity - self.pos)
+            self.buffer.write(self.pos, tuple(values[:first] for values in columns))
+            if first < size:
+                self.buffer.write(0, tuple(values[first:] for values in columns))
+        else:
+            for pos, experience in zip(positions, experience_list(experiences)):
+                if pos < len(self.buffer):
+                    self.buffer[pos] = experience
+                else:
+                    self.buffer.append(experience)
+
+        self.pos = (self.pos + size) % self.capacity
+
+        return positions
 
     def append(self, experience):
         self.buffer.append(experience)
 
-    def select_batch(self, batch_size):
+    def sample_indices(self, batch_size):
+        """ Randomly select positions in the buffer, with no replacement """
 
         # restrict to number of experiences available
         batch_size = min(batch_size, len(self.buffer))
 
         # randomly select experiences
-        indices = np.random.choice(len(self.buffer), batch_size, replace=False)
+        return np.random.choice(len(self.buffer), batch_size, replace=False)
 
-        return [self.buffer[idx] for idx in indices]
+    def select_batch(self, batch_size):
 
-    def sample(self, batch_size):
-        """ Sample from experience batch based on predetermined rules.
-        Main 'meat' from the class is in this method """
+        return [self.buffer[idx] for idx in self.sample_indices(batch_size)]
+
+    def take(self, indices):
+        """ Gather the experiences in the given positions, as one np array per variable """
 
-        batch = self.select_batch(batch_size)
+        # columnar storages gather the whole batch at once
+        if hasattr(self.buffer, "take"):
+            return self.buffer.take(indices)
 
         # break down into one tuple per variable of the experience
-        states, actions, rewards, dones, next_states = zip(*batch)
+        states, actions, rewards, dones, next_states = zip(*[self.buffer[idx] for idx in indices])
 
         # convert tuples into np arrays
         return np.array(states), np.array(actions), np.array(rewards, dtype=np.float32), \
             np.array(dones, dtype=np.uint8), np.array(next_states)
 
+    def sample(self, batch_size):
+        """ Sample from experience batch based on predetermined rules.
+        Main 'meat' from the class is in this method """
+
+        return self.take(self.sample_indices(batch_size))
+
+    def take_tensors(self, indices, device="cpu"):
+        """ Gather the experiences in the given positions as tensors, with dones as a bool mask
+
+            With columnar storage, the batch is written into tensors allocated in the first call and reused
+            afterwards, so tensors returned are only valid until the next call
+        """
+
+        device = torch.device(device)
+
+        # list storages: arrays are gathered and only wrapped, with no extra copy
+        if not hasattr(self.buffer, "take_into"):
+            states, actions, rewards, dones, next_states = self.take(indices)
+            tensors = (torch.from_numpy(states), torch.from_numpy(actions), torch.from_numpy(rewards),
+                torch.from_numpy(dones.view(np.bool_)), torch.from_numpy(next_states))
+            return tuple(t.to(device) for t in tensors)
+
+        # allocate tensors only when batch size changes
+        batch_tensors = getattr(self, "batch_tensors", None)
+        if batch_tensors is None or len(batch_tensors[0]) != len(indices):
+            batch_tensors = self.buffer.empty_tensors(len(indices))
+            self.batch_tensors = batch_tensors
+            self.device_tensors = batch_tensors
+            if device.type != "cpu":
+                self.device_tensors = tuple(torch.empty_like(t, device=device) for t in batch_tensors)
+
+        self.buffer.take_into(indices, self.batch_tensors)
+
+        # copy to preallocated tensors in the device
+        if device.type != "cpu":
+            for device_tensor, tensor in zip(self.device_tensors, self.batch_tensors):
+                device_tensor.copy_(tensor, non_blocking=True)
+
+        return self.device_tensors
+
+    def sample_tensors(self, batch_size, device="cpu"):
+        """ Same as sample, but batch is returned as tensors in the device """
+
+        return self.take_tensors(self.sample_indices(batch_size), device)
+
+    def select_shared(self, batch_size):
+        """ Same as select_batch, for storages in a shared pool. Returns positions in the pool instead of experiences """
+
+        return self.buffer.slots[self.sample_indices(batch_size)]
+
+    def receive_shared(self, slots):
+        """ Receive experiences by their positions in a shared pool, skipping the ones already in the buffer.
+            Returns the number of experiences received
+        """
+
+        slots = self.buffer.unseen(slots)
+        for slot in slots:
+            self.append(slot)
+
+        return len(slots)
+
+    def save(self, path):
+        """ Save experiences and state of the buffer to a folder, as one .npy file per array and a json header.
+
+            Arrays are written in chunks. The header is removed first and written last,
+            so a save interrupted halfway is never loaded
+        """
+
+        os.makedirs(path, exist_ok=True)
+        header_path = os.path.join(path, "buffer.json")
+        if os.path.exists(header_path):
+            os.remove(header_path)
+
+        header = {"capacity": self.capacity, "size": len(self.buffer)}
+        if hasattr(self.buffer, "save"):
+            header.update(self.buffer.save(path))
+        else:
+            header["storage"] = "list"
+            write_batches(path, EXPERIENCE_COLUMNS, self.take, len(self.buffer))
+        header.update(self.save_state(path))
+
+        # total number of writes, as kept by columnar storages
+        if "count" not in header:
+            header["count"] = header["size"] if header["size"] < self.capacity else self.capacity + header["pos"]
+
+        with open(header_path, "w") as f:
+            json.dump(header, f)
+
+    def load(self, path, mmap=False):
+        """ Restore a buffer saved with save, replacing its experiences.
+
+            With mmap, files are mapped copy-on-write and only read when accessed, changes are never written back
+        """
+
+        with open(os.path.join(path, "buffer.json")) as f:
+            header = json.load(f)
+
+        if header["capacity"] != self.capacity:
+            raise Exception("Buffer in {} has capacity {}, expected {}".format(
+                path, header["capacity"], self.capacity))
+
+        if header["size"] > 0:
+            if hasattr(self.buffer, "load"):
+                self.buffer.load(path, header, mmap)
+            elif header["storage"] == "frames":
+                raise Exception("Buffer in {} keeps frames, it can only be loaded into a FrameExperienceArray".format(path))
+            else:
+                columns = read_arrays(path, EXPERIENCE_COLUMNS, mmap)
+                self.buffer.clear()
+                self.buffer.extend(Experience(*values)
+                    for values in zip(*[column[:header["size"]] for column in columns]))
+        self.load_state(path, header, mmap)
+
+    def save_state(self, path):
+        """ Write arrays other than experiences and return values to keep in the header """
+
+        # position of the next write, as in ring buffers
+        return {"pos": len(self.buffer) % self.capacity}
+
+    def load_state(self, path, header, mmap=False):
+        """ Restore the state written by save_state """
+
+        # deque keeps the oldest experience first, in a full ring buffer it is in the next position to write
+        if isinstance(self.buffer, deque) and header["size"] == self.capacity:
+            self.buffer.rotate(-header["pos"])
+
+class ExperienceArray:
+    """ Columnar storage for experiences.
+
+        Preallocates one typed array per field (state, action, reward, done, next_state)
+        using the shape and dtype of the first experience written. Supports the list
+        operations the buffers use (len, append, indexing by position), plus take,
+        which gathers a whole batch with fancy indexing.
+    """
+
+    def __init__(self, capacity, state_dtype=None):
+
+        self.capacity = capacity
+        # type used for states and next states. if None, same as the first experience
+        self.state_dtype = state_dtype
+        self.size = 0
+        # total number of writes, used by ring buffers to find the next position to write
+        self.count = 0
+
+        # columns are only created when the first experience arrives
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.dones = None
+        self.next_states = None
+
+    def __len__(self):
+        return self.size
+
+    def allocate(self, experience):
+        """ Create one column per field, based on the first experience """
+
+        state, action, reward, done, next_state = experience
+
+        state = np.asarray(state)
+        action = np.asarray(action)
+        next_state = np.asarray(next_state)
+
+        self.states = self.create_column("states", state.shape, self.state_dtype or state.dtype)
+        self.actions = self.create_column("actions", action.shape, action.dtype)
+        # rewards and dones have fixed types, same as returned by ExperienceBuffer.sample
+        self.rewards = self.create_column("rewards", (), np.float32)
+        self.dones = self.create_column("dones", (), np.bool_)
+        self.next_states = self.create_column("next_states", next_state.shape, self.state_dtype or next_state.dtype)
+
+        # tensors sharing memory with the columns
+        self.tensor_columns = None
+
+    def create_column(self, name, shape, dtype):
+        """ Allocate the array for a single field. Overwrite to change where data is kept """
+
+        return np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+
+    def __getitem__(self, idx):
+        """ Return a single experience. Arrays are views into the storage """
+
+        return Experience(self.states[idx], self.actions[idx], self.rewards[idx],
+            self.dones[idx], self.next_states[idx])
+
+    def __setitem__(self, idx, experience):
+
+        if self.states is None:
+            self.allocate(experience)
+
+        state, action, reward, done, next_state = experience
+        self.states[idx] = state
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.dones[idx] = done
+        self.next_states[idx] = next_state
+        self.count += 1
+
+    def append(self, experience):
+        self[self.size] = experience
+        self.size += 1
+
+    def write(self, start, columns):
+        """ Write a batch of experiences in consecutive positions, given as one array per field """
+
+        if self.states is None:
+            self.allocate(Experience(*[values[0] for values in columns]))
+
+        end = start + len(columns[0])
+        for column, values in zip(self.columns(), columns):
+            column[start:end] = values
+        self.size = max(self.size, end)
+        self.count += end - start
+
+    def take(self, indices):
+        """ Gather a batch of experiences, one array per field """
+
+        # dones are stored as bool, but returned as uint8 to keep the format of ExperienceBuffer.sample
+        return self.states[indices], self.actions[indices], self.rewards[indices], \
+            self.dones[indices].view(np.uint8), self.next_states[indices]
+
+    def columns(self):
+        return self.states, self.actions, self.rewards, self.dones, self.next_states
+
+    def empty_tensors(self, batch_size):
+        """ Allocate tensors to hold a batch, with the same types as the columns """
+
+        tensors = []
+        for column in self.columns():
+            dtype = torch.from_numpy(column[:1]).dtype
+            tensors.append(torch.empty((batch_size,) + column.shape[1:], dtype=dtype))
+
+        return tuple(tensors)
+
+    def take_into(self, indices, out):
+        """ Gather a batch directly into the given tensors, with no intermediate arrays """
+
+        # tensor views of the columns are created once, columns are never reallocated
+        if self.tensor_columns is None:
+            self.tensor_columns = tuple(torch.from_numpy(column) for column in self.columns())
+
+        indices_v = torch.from_numpy(np.asarray(indices, dtype=np.int64))
+        for column_v, out_v in zip(self.tensor_columns, out):
+            torch.index_select(column_v, 0, indices_v, out=out_v)
+
+        return out
+
+    def save(self, path):
+        """ Write the columns to .npy files in the folder and return values to keep in the header.
+
+            Columns are written with the full capacity, so they can be mapped back directly
+        """
+
+        if self.states is not None:
+            for name, column in zip(EXPERIENCE_COLUMNS, self.columns()):
+                write_array(path, name, column)
+
+        return {"storage": "columns", "count": self.count}
+
+    def load(self, path, header, mmap=False):
+        """ Restore columns saved by a buffer, either with columnar or list storage """
+
+        if header["storage"] == "frames":
+            raise Exception("Buffer in {} keeps frames, it can only be loaded into a FrameExperienceArray".format(path))
+
+        size = header["size"]
+        columns = read_arrays(path, EXPERIENCE_COLUMNS, mmap)
+        if mmap and self.can_map(columns):
+            self.states, self.actions, self.rewards, self.dones, self.next_states = columns
+        else:
+            if self.states is None:
+                self.allocate(Experience(*[column[0] for column in columns]))
+            for out, values in zip(self.columns(), columns):
+                copy_rows(out, values[:size])
+
+        self.tensor_columns = None
+        self.size = size
+        self.count = header["count"]
+
+    def can_map(self, columns):
+        """ Columns from files are used directly only if they have the sizes and types the storage would allocate """
+
+        states, actions, rewards, dones, next_states = columns
+        return len(states) == self.capacity and dones.dtype == np.bool_ and rewards.dtype == np.float32 \
+            and self.state_dtype in (None, states.dtype)
+
+
+class MemmapExperienceArray(ExperienceArray):
+    """ Columnar storage kept in numpy.memmap files, for buffers larger than the available memory.
+
+        Each field is a raw file in the given folder, along with a json header with shapes and dtypes
+        and a counter of writes. Experiences written before a crash can be recovered by reopening the folder
+    """
+
+    def __init__(self, capacity, path, reopen=False, state_dtype=None):
+        super(MemmapExperienceArray, self).__init__(capacity, state_dtype)
+
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        # counter of writes is also kept on disk
+        self.header_path = os.path.join(self.path, "header.json")
+        reopen = reopen and os.path.exists(self.header_path)
+        self.meta = np.memmap(os.path.join(self.path, "meta.dat"), dtype=np.int64,
+            mode="r+" if reopen else "w+", shape=(1,))
+
+        if reopen:
+            self.reopen()
+
+    def reopen(self):
+        """ Map existing files, keeping the experiences written before """
+
+        with open(self.header_path) as f:
+            header = json.load(f)
+
+        if header["capacity"] != self.capacity:
+            raise Exception("Buffer in {} has capacity {}, expected {}".format(
+                self.path, header["capacity"], self.capacity))
+
+        for name, column in header["columns"].items():
+            setattr(self, name, np.memmap(os.path.join(self.path, name + ".dat"), mode="r+",
+                dtype=np.dtype(column["dtype"]), shape=(self.capacity,) + tuple(column["shape"])))
+
+        self.count = int(self.meta[0])
+        self.size = min(self.count, self.capacity)
+        self.tensor_columns = None
+
+    def allocate(self, experience):
+        super(MemmapExperienceArray, self).allocate(experience)
+
+        # save shapes and types, required to reopen the files
+        columns = {}
+        for name in ["states", "actions", "rewards", "dones", "next_states"]:
+            column = getattr(self, name)
+            columns[name] = {"shape": list(column.shape[1:]), "dtype": column.dtype.str}
+        with open(self.header_path, "w") as f:
+            json.dump({"capacity": self.capacity, "columns": columns}, f)
+
+    def create_column(self, name, shape, dtype):
+
+        return np.memmap(os.path.join(self.path, name + ".dat"), mode="w+",
+            dtype=dtype, shape=(self.capacity,) + tuple(shape))
+
+    def __setitem__(self, idx, experience):
+        super(MemmapExperienceArray, self).__setitem__(idx, experience)
+
+        self.meta[0] = self.count
+
+    def write(self, start, columns):
+        super(MemmapExperienceArray, self).write(start, columns)
+
+        self.meta[0] = self.count
+
+    def load(self, path, header, mmap=False):
+        # files of the checkpoint are only read, experiences are copied into the files of this storage
+        super(MemmapExperienceArray, self).load(path, header, mmap=True)
+
+        self.meta[0] = self.count
+
+    def can_map(self, columns):
+        return False
+
+    def take(self, indices):
+        """ Read rows in increasing order, so pages are accessed sequentially, and restore the original order """
+
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        sorted_batch = super(MemmapExperienceArray, self).take(indices[order])
+
+        batch = []
+        for sorted_values in sorted_batch:
+            values = np.empty_like(sorted_values)
+            values[order] = sorted_values
+            batch.append(values)
+
+        return tuple(batch)
+
+
+class FrameExperienceArray(ExperienceArray):
+    """ Columnar storage for stacked observations, in which every frame is kept only once.
+
+        States are stacks of frames along the first axis (as returned by BufferWrapper). Consecutive states
+        share all but one frame, and a state is the next state of the previous experience, so each experience
+        only references positions in a pool of frames. Stacks are rebuilt when the experiences are read.
+
+        Frames are reference counted: when an experience is overwritten, frames no longer used by any
+        experience go back to a free list. The pool grows if it runs out of free frames,
+        which happens when many experiences that do not follow each other are received (as in sharing).
+    """
+
+    def __init__(self, capacity, state_dtype=None):
+        super(FrameExperienceArray, self).__init__(capacity, state_dtype)
+
+        # position of each frame of the state and the next state in the pool of frames
+        self.state_refs = None
+        self.next_state_refs = None
+
+        # last experience written, to identify when the next one continues the same episode
+        self.last_next_state_refs = None
+        self.last_done = True
+
+    def allocate(self, experience):
+
+        state, action, reward, done, next_state = experience
+
+        state = np.asarray(state)
+        action = np.asarray(action)
+
+        self.n_frames = state.shape[0]
+        self.actions = self.create_column("actions", action.shape, action.dtype)
+        self.rewards = self.create_column("rewards", (), np.float32)
+        self.dones = self.create_column("dones", (), np.bool_)
+        self.state_refs = self.create_column("state_refs", (self.n_frames,), np.int64)
+        self.next_state_refs = self.create_column("next_state_refs", (self.n_frames,), np.int64)
+        self.tensor_columns = None
+
+        # one frame per experience, plus some room for the first state of each episode
+        pool_size = self.capacity + 2 * self.n_frames
+        self.frames = np.zeros((pool_size,) + state.shape[1:], dtype=self.state_dtype or state.dtype)
+        self.frames_v = torch.from_numpy(self.frames)
+        self.frame_refcount = np.zeros(pool_size, dtype=np.int32)
+        # stack of free positions in the pool, lowest positions are used first
+        self.free_frames = list(range(pool_size - 1, -1, -1))
+
+    def grow_frames(self):
+        """ Double the pool of frames """
+
+        pool_size = len(self.frames)
+        self.frames = np.concatenate([self.frames, np.zeros_like(self.frames)])
+        self.frames_v = torch.from_numpy(self.frames)
+        self.frame_refcount = np.concatenate([self.frame_refcount, np.zeros_like(self.frame_refcount)])
+        self.free_frames = list(range(2 * pool_size - 1, pool_size - 1, -1)) + self.free_frames
+
+    def add_frames(self, frames):
+        """ Copy frames into free positions of the pool and return the positions """
+
+        while len(self.free_frames) < len(frames):
+            self.grow_frames()
+
+        refs = np.array([self.free_frames.pop() for _ in range(len(frames))], dtype=np.int64)
+        self.frames[refs] = frames
+
+        return refs
+
+    def __getitem__(self, idx):
+        """ Return a single experience. States are rebuilt from the pool of frames """
+
+        return Experience(self.frames[self.state_refs[idx]], self.actions[idx], self.rewards[idx],
+            self.dones[idx], self.frames[self.next_state_refs[idx]])
+
+    def __setitem__(self, idx, experience):
+
+        if self.actions is None:
+            self.allocate(experience)
+
+        state, action, reward, done, next_state = experience
+        state = np.asarray(state)
+        next_state = np.asarray(next_state)
+
+        # if state is the last next state written, frames are already in the pool
+        if not self.last_done and np.array_equal(state, self.frames[self.last_next_state_refs]):
+            state_refs = self.last_next_state_refs
+        else:
+            state_refs = self.add_frames(state)
+
+        # next state is usually the state shifted by one frame, so only the newest frame is added
+        if np.array_equal(next_state[:-1], state[1:]):
+            next_state_refs = np.append(state_refs[1:], self.add_frames(next_state[-1:]))
+        else:
+            next_state_refs = self.add_frames(next_state)
+
+        # take references to new frames before releasing the frames of the experience overwritten
+        np.add.at(self.frame_refcount, state_refs, 1)
+        np.add.at(self.frame_refcount, next_state_refs, 1)
+        if idx < self.size:
+            self.release_frames(self.state_refs[idx])
+            self.release_frames(self.next_state_refs[idx])
+
+        self.state_refs[idx] = state_refs
+        self.next_state_refs[idx] = next_state_refs
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.dones[idx] = done
+        self.count += 1
+
+        self.last_next_state_refs = next_state_refs
+        self.last_done = done
+
+    def write(self, start, columns):
+        """ Frames are deduplicated against the previous experience, so experiences are written one at a time """
+
+        for offset, values in enumerate(zip(*columns)):
+            self[start + offset] = Experience(*values)
+        self.size = max(self.size, start + len(columns[0]))
+
+    def release_frames(self, refs):
+        """ Drop references, returning frames with no references left to the free list """
+
+        np.subtract.at(self.frame_refcount, refs, 1)
+        for ref in np.unique(refs[self.frame_refcount[refs] == 0]):
+            self.free_frames.append(ref)
+
+    def take(self, indices):
+        """ Gather a batch of experiences, rebuilding the stacks of frames """
+
+        return self.frames[self.state_refs[indices]], self.actions[indices], self.rewards[indices], \
+            self.dones[indices].view(np.uint8), self.frames[self.next_state_refs[indices]]
+
+    def empty_tensors(self, batch_size):
+
+        dtype = self.frames_v.dtype
+        states_shape = (batch_size, self.n_frames) + self.frames.shape[1:]
+        tensors = super(FrameExperienceArray, self).empty_tensors(batch_size)
+
+        return (torch.empty(states_shape, dtype=dtype),) + tensors[1:4] + (torch.empty(states_shape, dtype=dtype),)
+
+    def columns(self):
+        # states are gathered from the pool of frames, see take_into
+        return self.state_refs, self.actions, self.rewards, self.dones, self.next_state_refs
+
+    def take_into(self, indices, out):
+
+        indices_v = torch.from_numpy(np.asarray(indices, dtype=np.int64))
+        states_v, actions_v, rewards_v, dones_v, next_states_v = out
+
+        if self.tensor_columns is None:
+            self.tensor_columns = tuple(torch.from_numpy(column) for column in self.columns())
+
+        for column_v, out_v in zip(self.tensor_columns[1:4], out[1:4]):
+            torch.index_select(column_v, 0, indices_v, out=out_v)
+
+        # frames of all stacks are gathered at once, into a flat view of the output
+        frame_shape = self.frames.shape[1:]
+        for refs, out_v in [(self.state_refs, states_v), (self.next_state_refs, next_states_v)]:
+            refs_v = torch.from_numpy(refs[indices].ravel())
+            torch.index_select(self.frames_v, 0, refs_v, out=out_v.view((-1,) + frame_shape))
+
+        return out
+
+    def save(self, path):
+        """ Write the pool of frames and the references of each experience, keeping frames deduplicated """
+
+        header = {"storage": "frames", "count": self.count}
+        if self.actions is None:
+            return header
+
+        for name in FRAME_ARRAYS:
+            write_array(path, name, getattr(self, name))
+        write_array(path, "free_frames", np.array(self.free_frames, dtype=np.int64))
+
+        # the last experience written tells if the next one continues the same episode
+        header["last_done"] = bool(self.last_done)
+        header["last_next_state_refs"] = None if self.last_next_state_refs is None \
+            else [int(ref) for ref in self.last_next_state_refs]
+
+        return header
+
+    def load(self, path, header, mmap=False):
+
+        if header["storage"] != "frames":
+            raise Exception("Buffer in {} does not keep frames, it can't be loaded into a FrameExperienceArray".format(path))
+
+        for name, values in zip(FRAME_ARRAYS, read_arrays(path, FRAME_ARRAYS, mmap)):
+            setattr(self, name, values)
+        self.free_frames = read_arrays(path, ["free_frames"])[0].tolist()
+
+        self.n_frames = self.state_refs.shape[1]
+        self.frames_v = torch.from_numpy(self.frames)
+        self.tensor_columns = None
+        self.size = header["size"]
+        self.count = header["count"]
+        self.last_done = header["last_done"]
+        self.last_next_state_refs = None
+        if header["last_next_state_refs"] is not None:
+            self.last_next_state_refs = np.array(header["last_next_state_refs"], dtype=np.int64)
+
+
+class ArrayExperienceBuffer(ExperienceBuffer):
+    """ Ring buffer backed by columnar storage.
+
+        Same interface as ExperienceBuffer, but experiences are written into preallocated
+        arrays and sample gathers the batch directly, without building per-sample objects
+    """
+
+    def __init__(self, capacity, storage=None):
+
+        self.capacity = capacity
+        # storage can be replaced by any object with the interface of ExperienceArray
+        if storage is None:
+            storage = ExperienceArray(capacity)
+        self.buffer = storage
+        # storage may be reopened with experiences in it
+        self.pos = self.buffer.count % self.capacity
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, experience):
+
+        if len(self.buffer) < self.capacity:
+            # if buffer not full, append new transition
+            self.buffer.append(experience)
+        else:
+            # otherwise overwrite oldest position
+            self.buffer[self.pos] = experience
+
+        # adjust position - when ends, goes back to zero
+        self.pos = (self.pos + 1) % self.capacity
+
+    def sample_indices(self, batch_size):
+        """ Randomly select positions in the buffer, with no replacement """
+
+        # restrict to number of experiences available
+        size = len(self.buffer)
+        batch_size = min(batch_size, size)
+
+        # np.random.choice with no replacement permutes the whole buffer
+        # drawing with replacement is O(batch), only fallback if there are repeated positions
+        indices = np.random.randint(size, size=batch_size)
+        if len(np.unique(indices)) < batch_size:
+            indices = np.random.choice(size, batch_size, replace=False)
+
+        return indices
+
+    def save_state(self, path):
+
+        header = super(ArrayExperienceBuffer, self).save_state(path)
+        header["pos"] = self.pos
+
+        return header
+
+    def load_state(self, path, header, mmap=False):
+        super(ArrayExperienceBuffer, self).load_state(path, header, mmap)
+
+        self.pos = header["pos"]
+
 class EpisodeBuffer:
 
     def __init__(self, capacity, cutoff_percentile):
@@ -199,14 +1033,19 @@ class EpisodeBuffer:
 class PrioReplayBuffer(ExperienceBuffer):
     """ implementation from From Deep Reinforcement Learning Handson book """
 
-    def __init__(self, capacity, prob_alpha=0.6):
+    def __init__(self, capacity, prob_alpha=0.6, storage=None):
 
         self.prob_alpha = prob_alpha
         self.capacity = capacity
-        self.pos = 0
-        self.buffer = []
+        self.buffer = [] if storage is None else storage
+        # storage may be reopened with experiences in it
+        self.pos = 0 if storage is None else storage.count % self.capacity
         self.priorities = np.zeros((capacity, ), dtype=np.float32)
 
+        # experiences already in a reopened storage start with the same priority
+        if len(self.buffer) > 0:
+            self.set_priority(np.arange(len(self.buffer)), 1.0)
+
     def __len__(self):
         return len(self.buffer)
 
@@ -214,7 +1053,7 @@ class PrioReplayBuffer(ExperienceBuffer):
         """ Pull the given amount of transitions form the experience source object and store them in buffer """
 
         # set experience to maximum priority when it enter the buffer
-        max_prio = self.priorities.max() if self.buffer else 1.0
+        max_prio = self.max_priority()
 
         if len(self.buffer) < self.capacity:
             # if buffer not full, append new transition
@@ -224,19 +1063,32 @@ class PrioReplayBuffer(ExperienceBuffer):
             self.buffer[self.pos] = experience
 
         # set priorities
-        self.priorities[self.pos] = max_prio
+        self.set_priority(self.pos, max_prio)
 
         # adjust position - when ends, goes back to zero
         self.pos = (self.pos + 1) % self.capacity
 
-    def select_batch(self, batch_size):
-        """ Need to similar calculation as in samples, but do not do any updates or calculate weights are needed.
+    def receive(self, experiences):
+        """ Write the batch at once, all experiences with the maximum priority """
 
-            Don't need beta since no importance sampling is done in the method
-        """
+        max_prio = self.max_priority()
+        for part in self.batch_parts(experiences):
+            positions = self.write_batch(part)
+            if len(positions) > 0:
+                self.set_priority(positions, max_prio)
 
-        # restrict to number of experiences available
-        batch_size = min(batch_size, len(self.buffer))
+    def max_priority(self):
+        """ Priority given to new experiences """
+
+        return self.priorities.max() if self.buffer else 1.0
+
+    def set_priority(self, idx, prio):
+        """ Set priority for one position, or for an array of unique positions """
+
+        self.priorities[idx] = prio
+
+    def sample_indices(self, batch_size):
+        """ Sample positions according to priorities. Return positions and their probabilities """
 
         # calculate probabilities
         if len(self.buffer) == self.capacity:
@@ -249,36 +1101,229 @@ class PrioReplayBuffer(ExperienceBuffer):
         # with probabilities, sample buffer
         indices = np.random.choice(len(self.buffer), batch_size, p=probs)
 
+        return indices, probs[indices]
+
+    def select_batch(self, batch_size):
+        """ Need to similar calculation as in samples, but do not do any updates or calculate weights are needed.
+
+            Don't need beta since no importance sampling is done in the method
+        """
+
+        # restrict to number of experiences available
+        batch_size = min(batch_size, len(self.buffer))
+
+        indices, _ = self.sample_indices(batch_size)
+
         return [self.buffer[idx] for idx in indices]
 
+    def select_shared(self, batch_size):
+
+        batch_size = min(batch_size, len(self.buffer))
+        indices, _ = self.sample_indices(batch_size)
+
+        return self.buffer.slots[indices]
+
     def sample(self, batch_size, beta=0.4):
         """ Convert priorities to probabilities using alpha parameters """
 
-        # calculate probabilities
-        if len(self.buffer) == self.capacity:
-            prios = self.priorities
-        else:
-            prios = self.priorities[:self.pos]
-        probs = prios ** self.prob_alpha
-        probs /= probs.sum()
-
         # with probabilities, sample buffer
-        indices = np.random.choice(len(self.buffer), batch_size, p=probs)
-        samples = zip(*[self.buffer[idx] for idx in indices])
+        indices, probs = self.sample_indices(batch_size)
+        samples = self.take(indices)
 
         # calculate importance sampling weights
-        total = len(self.buffer)
-        weights = (total * probs[indices]) ** (-beta)
-        weights /= weights.max()
+        weights = self.calculate_weights(probs, beta)
 
         # also return indices, since they are required to update priorities for sampled items
         return samples, indices, weights
 
+    def sample_tensors(self, batch_size, beta=0.4, device="cpu"):
+        """ Same as sample, but batch is returned as tensors in the device """
+
+        indices, probs = self.sample_indices(batch_size)
+
+        return self.take_tensors(indices, device), indices, self.calculate_weights(probs, beta)
+
+    def calculate_weights(self, probs, beta):
+        """ Importance sampling weights, normalized by the largest weight in the batch """
+
+        total = len(self.buffer)
+        weights = (total * probs) ** (-beta)
+        weights /= weights.max()
+
+        return weights
+
     def update_priorities(self, batch_indices, batch_priorities):
-        """ Update new priorities for the processed batch """
+        """ Update new priorities for the processed batch, in a single vectorized call
+
+            Priorities can be an array or a tensor. Sampling is done with replacement, so the same
+            position can appear more than once in a batch - in that case the last priority is kept
+        """
+
+        # accept tensors, moving them to cpu if required
+        if hasattr(batch_priorities, "detach"):
+            batch_priorities = batch_priorities.detach().cpu().numpy()
+
+        batch_indices = np.asarray(batch_indices)
+        batch_priorities = np.asarray(batch_priorities, dtype=np.float32)
+
+        # keep only the last occurrence of each position
+        _, reversed_first = np.unique(batch_indices[::-1], return_index=True)
+        last = len(batch_indices) - 1 - reversed_first
+
+        self.set_priority(batch_indices[last], batch_priorities[last])
+
+    def save_state(self, path):
+
+        header = super(PrioReplayBuffer, self).save_state(path)
+        header["pos"] = self.pos
+        header["prioritized"] = True
+        write_array(path, "priorities", self.priorities)
+
+        return header
+
+    def load_state(self, path, header, mmap=False):
+        super(PrioReplayBuffer, self).load_state(path, header, mmap)
+
+        self.pos = header["pos"]
+        self.priorities[:] = 0
+        if header["size"] > 0:
+            # experiences saved by buffers with no priorities start with the same priority
+            priorities = 1.0
+            if header.get("prioritized", False):
+                priorities = read_arrays(path, ["priorities"])[0][:header["size"]]
+            self.set_priority(np.arange(header["size"]), priorities)
+
+
+class SegmentTree:
+    """ Binary tree kept in a flat array, in which every node holds the operation applied to its two children.
+        Leaves, in the second half of the array, hold one value per buffer position.
+        Updating leaves and querying the whole range costs O(log n)
+    """
+
+    def __init__(self, capacity, operation, neutral_element):
+
+        # number of leaves is rounded up to a power of two
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+
+        self.operation = operation
+        self.tree = np.full(2 * self.size, neutral_element, dtype=np.float64)
+
+    def __getitem__(self, indices):
+        """ Get leaves values """
+
+        return self.tree[np.asarray(indices) + self.size]
+
+    def __setitem__(self, indices, values):
+        """ Set leaves values and recalculate all their ancestors, one level at a time """
+
+        nodes = np.atleast_1d(np.asarray(indices) + self.size)
+        self.tree[nodes] = values
+
+        nodes = np.unique(nodes // 2)
+        # root is at position 1
+        while nodes[0] > 0:
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def reduce(self):
+        """ Operation applied over all leaves, kept at the root """
+
+        return self.tree[1]
+
+class SumSegmentTree(SegmentTree):
+
+    def __init__(self, capacity):
+        super(SumSegmentTree, self).__init__(capacity, np.add, 0.0)
+
+    def find_prefixsum_idx(self, prefixsums):
+        """ For each prefix sum, find the highest leaf such that the sum of all leaves before it is lower than the prefix sum.
+            All prefix sums descend the tree together
+        """
+
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        while nodes[0] < self.size:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            # go right when the left subtree does not cover the remaining mass
+            go_right = prefixsums > left_sums
+            prefixsums -= left_sums * go_right
+            nodes = left + go_right
+
+        return nodes - self.size
+
+class MinSegmentTree(SegmentTree):
+
+    def __init__(self, capacity):
+        super(MinSegmentTree, self).__init__(capacity, np.minimum, np.inf)
+
+
+class SumTreePrioReplayBuffer(PrioReplayBuffer):
+    """ Prioritized replay buffer in which sampling and priority updates are O(log n) instead of O(capacity).
+
+        Priorities raised to alpha are kept in a sum tree, used to sample proportionally, and in a min tree,
+        used to normalize importance sampling weights by the maximum possible weight.
+        Raw priorities are still kept in self.priorities, for buffers that read them directly.
+    """
+
+    def __init__(self, capacity, prob_alpha=0.6, storage=None):
+
+        # trees are created first, since priorities may be set when initializing the buffer
+        self.sum_tree = SumSegmentTree(capacity)
+        self.min_tree = MinSegmentTree(capacity)
+
+        # running max, new experiences enter with the highest priority seen so far
+        self.running_max_priority = 1.0
+
+        super(SumTreePrioReplayBuffer, self).__init__(capacity, prob_alpha, storage)
+
+    def max_priority(self):
+
+        return self.running_max_priority
+
+    def set_priority(self, idx, prio):
+
+        self.priorities[idx] = prio
+        prio_alpha = prio ** self.prob_alpha
+        self.sum_tree[idx] = prio_alpha
+        self.min_tree[idx] = prio_alpha
+        self.running_max_priority = max(self.running_max_priority, float(np.max(prio)))
+
+    def sample_indices(self, batch_size):
+
+        # draw a random mass for each sample and find where it falls in the sum tree
+        total_prio = self.sum_tree.reduce()
+        prefixsums = np.random.random(batch_size) * total_prio
+        indices = self.sum_tree.find_prefixsum_idx(prefixsums)
+        # guards against rounding errors landing on an empty leaf
+        indices = np.minimum(indices, len(self.buffer) - 1)
+
+        return indices, self.sum_tree[indices] / total_prio
+
+    def calculate_weights(self, probs, beta):
+        """ Normalize by the largest weight possible, which comes from the lowest priority in the buffer """
+
+        total = len(self.buffer)
+        min_prob = self.min_tree.reduce() / self.sum_tree.reduce()
+        max_weight = (total * min_prob) ** (-beta)
+        weights = (total * probs) ** (-beta) / max_weight
+
+        return weights.astype(np.float32)
+
+    def save_state(self, path):
+
+        header = super(SumTreePrioReplayBuffer, self).save_state(path)
+        header["running_max_priority"] = float(self.running_max_priority)
+
+        return header
+
+    def load_state(self, path, header, mmap=False):
+        super(SumTreePrioReplayBuffer, self).load_state(path, header, mmap)
 
-        for idx, prio in zip(batch_indices, batch_priorities):
-           self.priorities[idx] = prio
+        # trees are rebuilt from the priorities, running max may be higher than the priorities left in the buffer
+        self.running_max_priority = header.get("running_max_priority", self.running_max_priority)
 
 
 
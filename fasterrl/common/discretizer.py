@@ -1,13 +1,124 @@
 import numpy as np
+from bisect import bisect_right
 from itertools import product
-from skimage.measure import block_reduce
+
+
+def block_mean(samples, block):
+    """ Mean of each block in a batch of samples, with the block given for a single sample.
+
+        Incomplete blocks at the edges are padded with zeros, same as skimage block_reduce.
+        Without padding, blocks are a reshaped view of the samples, so only the means are allocated
+    """
+
+    samples = np.asarray(samples)
+    shape = samples.shape[1:]
+
+    padding = [(0, -size % b) for size, b in zip(shape, block)]
+    if any(after for _, after in padding):
+        samples = np.pad(samples, [(0, 0)] + padding)
+        shape = samples.shape[1:]
+
+    # each dimension is split in (number of blocks, block), and the block dimensions are averaged
+    split_shape = [len(samples)]
+    for size, b in zip(shape, block):
+        split_shape += [size // b, b]
+
+    return samples.reshape(split_shape).mean(axis=tuple(range(2, len(split_shape), 2)))
+
+
+class QuantileSketch:
+    """ Streaming estimate of the distribution of each var, in the style of a merging t-digest.
+
+        Samples are kept in a buffer, merged into a fixed number of weighted centroids per var when full.
+        Each centroid holds an equal share of the samples seen, and quantiles are interpolated between centroids
+    """
+
+    def __init__(self, n_vars, num_centroids=100, buffer_size=500):
+
+        self.n_vars = n_vars
+        self.num_centroids = num_centroids
+        self.count = 0
+
+        # centroids of each var, sorted by mean. empty centroids have no weight
+        self.means = np.zeros((n_vars, 0))
+        self.weights = np.zeros((n_vars, 0))
+        self.low = np.full(n_vars, np.inf)
+        self.high = np.full(n_vars, -np.inf)
+
+        # samples not merged yet
+        self.buffer = np.zeros((buffer_size, n_vars))
+        self.buffered = 0
+
+    def update(self, sample):
+
+        self.buffer[self.buffered] = sample
+        self.buffered += 1
+        self.count += 1
+        if self.buffered == len(self.buffer):
+            self.merge()
+
+    def merge(self):
+        """ Merge the buffered samples into the centroids """
+
+        if self.buffered == 0:
+            return
+
+        samples = self.buffer[:self.buffered].T
+        self.low = np.minimum(self.low, samples.min(axis=1))
+        self.high = np.maximum(self.high, samples.max(axis=1))
+
+        means = np.concatenate([self.means, samples], axis=1)
+        weights = np.concatenate([self.weights, np.ones(samples.shape)], axis=1)
+        order = np.argsort(means, axis=1, kind="stable")
+        means = np.take_along_axis(means, order, axis=1)
+        weights = np.take_along_axis(weights, order, axis=1)
+
+        # each point goes to the centroid of the share of the total weight where its midpoint falls
+        cumulative = np.cumsum(weights, axis=1)
+        shares = (cumulative - weights / 2) / cumulative[:, -1:]
+        groups = np.minimum((shares * self.num_centroids).astype(np.int64), self.num_centroids - 1)
+        # groups of all vars are counted at once, with an offset for each var
+        groups += np.arange(self.n_vars)[:, None] * self.num_centroids
+
+        size = self.n_vars * self.num_centroids
+        shape = (self.n_vars, self.num_centroids)
+        self.weights = np.bincount(groups.ravel(), weights.ravel(), minlength=size).reshape(shape)
+        sums = np.bincount(groups.ravel(), (weights * means).ravel(), minlength=size).reshape(shape)
+        # empty centroids are placed at the maximum, keeping the means sorted
+        self.means = np.where(self.weights > 0, sums / np.maximum(self.weights, 1e-12), self.high[:, None])
+
+        self.buffered = 0
+
+    def quantiles(self, v, qs):
+        """ Estimate of the quantiles qs of var v """
+
+        self.merge()
+
+        weights = self.weights[v]
+        means = self.means[v][weights > 0]
+        weights = weights[weights > 0]
+
+        # mean of each centroid is placed at the middle of its weight, extremes at the ends
+        midpoints = np.cumsum(weights) - weights / 2
+        positions = np.concatenate([[0], midpoints, [weights.sum()]])
+        values = np.concatenate([[self.low[v]], means, [self.high[v]]])
+
+        return np.interp(np.asarray(qs) * weights.sum(), positions, values)
+
 
 class Discretizer():
     # discretizer should not access the environment - leave the agent or buffer do the sampling
 
-    def __init__(self, space, bin_size=None, bin_sizes=None):
+    def __init__(self, space, bin_size=None, bin_sizes=None, flat=False, reduce_block=None):
 
         self.space = space
+
+        # if flat, discrete states are a single int id instead of a tuple with the position of each var
+        self.flat = flat
+
+        # online discretizers fit the bins to the samples observed, notifying listeners when bins change
+        self.sketch = None
+        self.refit_listeners = []
         
         # check if it is image
         self.image = False
@@ -34,8 +145,10 @@ class Discretizer():
         # if image, requires a reduce block, bounds set to [0,1] and reduced bin size
         else: 
 
-            self.n_vars = 9 # manually set for now, calculate later
-            self.reduce_block  = (4,28,28) # converts (4,84,84) to (1,3,3)
+            self.reduce_block = tuple(reduce_block or (4,28,28)) # default converts (4,84,84) to (1,3,3)
+            # one var per block. incomplete blocks at the edges are padded with zeros
+            reduced_shape = -(-np.array(self.space.shape) // np.array(self.reduce_block))
+            self.n_vars = int(np.prod(reduced_shape))
 
             # manually set the bounds to [0,1]
             self.lower_bounds = [0] * self.n_vars
@@ -47,23 +160,96 @@ class Discretizer():
 
         self.bin_sizes = bin_sizes or [self.bin_size for var in range(self.n_vars)]
 
+        # flat id of a discrete sample is the dot product with the strides of the vars
+        self.flat_strides = np.array([int(np.prod(self.bin_sizes[v + 1:])) for v in range(self.n_vars)], dtype=np.int64)
+        self.flat_stride_list = self.flat_strides.tolist()
+
         # calculate state bins
-        self.bins = []
+        bins = []
         for v in range(self.n_vars):
             low, high = self.lower_bounds[v], self.upper_bounds[v]
-            bins = np.histogram_bin_edges([low, high], bins=self.bin_sizes[v])
-            self.bins.append(bins[1:-1])
+            var_bins = np.histogram_bin_edges([low, high], bins=self.bin_sizes[v])
+            bins.append(var_bins[1:-1])
+        self.set_bins(bins)
 
-    def convert(self, sample):
+    def set_bins(self, bins):
+        """ Inner edges of the bins of each var. Also kept as lists, for the single sample conversion """
+
+        self.bins = bins
+        self.bin_lists = [var_bins.tolist() for var_bins in bins]
+
+    def reduce(self, samples):
+        """ Samples as an array of shape (samples, vars). Images pass through the reduce block first """
+
+        samples = np.asarray(samples)
+
+        # reduce block is applied to all images together
+        if self.image:
+            samples = block_mean(samples, self.reduce_block)
+
+        return samples.reshape(len(samples), -1)
+
+    def state_count(self):
+        """ Number of discrete states, the range of the flat ids """
+
+        return int(np.prod(self.bin_sizes))
+
+    def discretize(self, sample):
+        """ Position of each var in its bins, for a single sample """
 
         # if image, needs to pass through reduce block first
         if self.image:
-            sample = block_reduce(sample, self.reduce_block, func=np.mean).ravel()
+            sample = block_mean([sample], self.reduce_block).ravel()
+
+        # same binning as np.digitize, but on python floats, much faster for a single sample
+        sample = np.asarray(sample, dtype=np.float64).tolist()
+        return [bisect_right(b, s) for s, b in zip(sample, self.bin_lists)]
+
+    def flat_id(self, discrete_sample):
+        """ Single int id of a discrete sample, as in np.ravel_multi_index over the bin sizes """
+
+        return sum([d * stride for d, stride in zip(discrete_sample, self.flat_stride_list)])
 
+    def convert(self, sample):
+
+        discrete_sample = self.discretize(sample)
+        if self.flat:
+            return self.flat_id(discrete_sample)
 
-        discrete_sample = [int(np.digitize(s, b)) for s,b in zip(sample, self.bins)]
         return tuple(discrete_sample)
 
+    def convert_flat(self, sample):
+        """ Flat id of a sample, regardless of the output of convert """
+
+        return self.flat_id(self.discretize(sample))
+
+    def convert_batch(self, samples, flat=False):
+        """ Discretize several samples at once. Returns an array with one row per sample and one column per var.
+
+            - flat: return instead the flat id of each sample, as in np.ravel_multi_index over the bin sizes
+        """
+
+        discrete_samples = self.digitize_batch(self.reduce(samples), self.bins)
+
+        if flat:
+            return discrete_samples @ self.flat_strides
+        return discrete_samples
+
+    def convert_all(self, samples):
+        """ Output of convert for several samples at once, as an array with one row per sample """
+
+        return self.convert_batch(samples, flat=self.flat)
+
+    def digitize_batch(self, samples, bins):
+        """ Position of each var in its bins, for a batch of samples. A single search per var """
+
+        discrete_samples = np.zeros((len(samples), len(bins)), dtype=np.int64)
+        for v, var_bins in enumerate(bins):
+            # right side is the same as np.digitize, a value equal to an edge goes to the bin above it
+            discrete_samples[:, v] = np.searchsorted(var_bins, samples[:, v], side="right")
+
+        return discrete_samples
+
     def define_bins_from_samples(self, samples):
 
         # convert to array if given in samples
@@ -71,10 +257,79 @@ class Discretizer():
             samples = np.array(samples)
 
         # recalculate bins
-        self.bins = []
+        bins = []
         for v in range(self.n_vars):
-            bins = np.histogram_bin_edges(samples[:, v], bins=self.bin_sizes[v])
-            self.bins.append(bins[1:-1])
+            var_bins = np.histogram_bin_edges(samples[:, v], bins=self.bin_sizes[v])
+            bins.append(var_bins[1:-1])
+        self.set_bins(bins)
+
+    def set_online(self, refit_interval, num_centroids=100):
+        """ Fit the bins to the quantiles of the samples observed, every refit_interval samples.
+
+            Bins of each var hold equal shares of the samples. Bounds of the space are only used until the first refit
+        """
+
+        self.sketch = QuantileSketch(self.n_vars, num_centroids)
+        self.refit_interval = refit_interval
+
+    def add_refit_listener(self, listener):
+        """ listener is called with the mapping of bins after every refit, as in remap_states """
+
+        self.refit_listeners.append(listener)
+
+    def observe(self, sample):
+        """ Add a sample to the distribution of an online discretizer, refitting bins on schedule """
+
+        self.sketch.update(self.reduce([sample])[0])
+        if self.sketch.count % self.refit_interval == 0:
+            self.refit()
+
+    def observe_batch(self, samples):
+        """ Add several samples to the distribution, in order, refitting bins on the same schedule as observe """
+
+        for sample in self.reduce(samples):
+            self.sketch.update(sample)
+            if self.sketch.count % self.refit_interval == 0:
+                self.refit()
+
+    def refit(self):
+        """ Set bins to the quantiles of the samples observed.
+
+            Returns, for each var, the old bin of the center of each new bin
+        """
+
+        bins = []
+        var_maps = []
+        for v, size in enumerate(self.bin_sizes):
+            var_bins = self.sketch.quantiles(v, np.arange(1, size) / size)
+            bins.append(var_bins)
+            # values in a new bin are assumed to be in the old bin of its center
+            edges = np.concatenate([[self.sketch.low[v]], var_bins, [self.sketch.high[v]]])
+            centers = (edges[:-1] + edges[1:]) / 2
+            var_maps.append(np.searchsorted(self.bin_lists[v], centers, side="right"))
+
+        self.set_bins(bins)
+
+        for listener in self.refit_listeners:
+            listener(var_maps)
+
+        return var_maps
+
+    def remap_states(self, table, var_maps, axis=0):
+        """ Move the entries of a table indexed by discrete states to the bins after a refit.
+
+            States are in the dimensions starting at axis, one per var, or a single one with flat ids
+        """
+
+        shape = table.shape
+        if self.flat:
+            table = table.reshape(shape[:axis] + tuple(self.bin_sizes) + shape[axis + 1:])
+
+        remapped = table[(slice(None),) * axis + np.ix_(*var_maps)]
+
+        if self.flat:
+            remapped = remapped.reshape(shape)
+        return remapped
 
     def calculate_grid_positions(self, action_size):
         """ Calculate all possible positions in the grid """
@@ -93,59 +348,112 @@ class TileDiscretizer(Discretizer):
     # what other options are there?
     # how do I handle infinity in state discretization?
 
-    def __init__(self, space, bin_size=None, bin_sizes=None, offsets=None):
-        super(TileDiscretizer, self).__init__(space, bin_size, bin_sizes)
-
-        self.intervals = self.upper_bounds - self.lower_bounds
+    def __init__(self, space, bin_size=None, bin_sizes=None, offsets=None, flat=False, reduce_block=None, hash_size=None):
+        """
+            - hash_size: if given, the output of convert is the index of each tile in a table of this size,
+            from a hash of the tile and its cell. Memory is bounded regardless of the number of vars
+        """
 
         # alternatively, can define a number of tiles hyperparameter for optimization
         # and randomly initialize the offsets
+        # offsets are set first, since the base constructor already sets the bins of the tiles
         self.offsets = offsets or [0, -.05, -0.1, +0.05, + 0.1]
 
-        # calculate state bins
-        self.bins = []
-        for idx_offset, offset in enumerate(self.offsets):
-            self.bins.append([])
-            for v in range(self.n_vars):
-                offset_v = offset * self.intervals[v]
-                low, high = self.lower_bounds[v], self.upper_bounds[v]
-                bins = np.histogram_bin_edges([low, high], bins=self.bin_sizes[v])
-                self.bins[idx_offset].append(bins[1:-1] + offset_v)
+        super(TileDiscretizer, self).__init__(space, bin_size, bin_sizes, flat, reduce_block)
+
+        self.hash_size = hash_size
+        # random odd multipliers for the position of each var and for the tile, fixed so indices are reproducible
+        rng = np.random.default_rng(0)
+        multipliers = rng.integers(0, 2 ** 63, size=self.n_vars + 1, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.hash_multipliers = multipliers[:-1]
+        self.hash_tile_keys = np.arange(self.tiles_count(), dtype=np.uint64) * multipliers[-1]
+
+    def set_bins(self, bins):
+        """ Bins of each tile are the bins given, displaced by the offset of the tile """
+
+        super(TileDiscretizer, self).set_bins(bins)
+
+        # bins shared by all tiles, the displacement is applied to the samples
+        self.base_bins = bins
+        # displacement of each var in each tile, with shape (tiles, vars)
+        self.intervals = self.upper_bounds - self.lower_bounds
+        self.tile_shifts = np.array([[offset * self.intervals[v] for v in range(self.n_vars)] for offset in self.offsets])
+        self.tile_shift_lists = self.tile_shifts.tolist()
+
+        self.bins = [[var_bins + shift for var_bins, shift in zip(bins, tile_shifts)] for tile_shifts in self.tile_shifts]
 
     def tiles_count(self):
         return len(self.offsets)
 
+    def discretize(self, sample):
+        """ Position of each var in its bins, for a single sample. One list per tile """
+
+        # samples are displaced instead of the bins, so all tiles share the same bins
+        sample = np.asarray(sample, dtype=np.float64).tolist()
+        discrete_sample = []
+        for tile_shifts in self.tile_shift_lists:
+            discrete_var = [bisect_right(b, s - shift) for s, shift, b in zip(sample, tile_shifts, self.bin_lists)]
+            discrete_sample.append(discrete_var)
+
+        return discrete_sample
+
     def convert(self, sample):
         """ Output is no longer in the form (x,y,z) as in regular state aggregation, but in the form of ((x1, y1, z1), (x2, y2, z2), (x3, y3, z3)).
 
-            Every var is represented by the position of several tiles and similar displacements for different dimension are grouped 
+            Every var is represented by the position of several tiles and similar displacements for different dimension are grouped.
+            If flat, the output is the flat id in each tile instead, (s1, s2, s3). If hashed, the index of each tile in the table
         """
 
-        # make it more explicit
-        discrete_sample = []
-        for offset_bins in self.bins:
-            discrete_var = []
-            for s, bin in zip(sample, offset_bins):
-                discrete_var.append(int(np.digitize(s, bin)))
-            discrete_sample.append(tuple(discrete_var))
+        if self.hash_size:
+            return tuple(self.hash_cells(np.array(self.discretize(sample))).tolist())
+        if self.flat:
+            return self.convert_flat(sample)
 
-        return tuple(discrete_sample)
+        return tuple([tuple(discrete_var) for discrete_var in self.discretize(sample)])
 
-    def define_bins_from_samples(self, samples):
-        """ Similar to state aggregation method, but adding the offsets """
+    def convert_flat(self, sample):
+        """ Flat id of a sample in each tile, regardless of the output of convert """
 
-        # convert to array if given in samples
-        if type(samples) is not np.ndarray:
-            samples = np.array(samples)
+        return tuple([self.flat_id(discrete_var) for discrete_var in self.discretize(sample)])
 
-        # recalculate bins
-        self.bins = []
-        for idx_offset, offset in enumerate(self.offsets):
-            self.bins.append([])
-            for v in range(self.n_vars):
-                offset_v = offset * self.intervals[v]
-                bins = np.histogram_bin_edges(samples[:, v], bins=self.bin_sizes[v])
-                self.bins[idx_offset].append(bins[1:-1] + offset_v)
+    def convert_batch(self, samples, flat=False):
+        """ Discretize several samples at once. Returns an array of shape (samples, tiles, vars).
+
+            - flat: return instead the flat id of each sample in each tile, with shape (samples, tiles)
+        """
+
+        samples = self.reduce(samples).astype(np.float64)
+
+        # a single search per var, for all tiles, with the samples displaced by the offset of each tile
+        discrete_samples = np.zeros((len(samples), self.tiles_count(), self.n_vars), dtype=np.int64)
+        for v, var_bins in enumerate(self.base_bins):
+            shifted = samples[:, v, None] - self.tile_shifts[:, v]
+            discrete_samples[:, :, v] = np.searchsorted(var_bins, shifted, side="right")
+
+        if flat:
+            return discrete_samples @ self.flat_strides
+        return discrete_samples
+
+    def convert_all(self, samples):
+        """ Output of convert for several samples at once. Returns an array of shape (samples, tiles, vars),
+            or (samples, tiles) if flat or hashed
+        """
+
+        if self.hash_size:
+            return self.hash_cells(self.convert_batch(samples))
+
+        return self.convert_batch(samples, flat=self.flat)
+
+    def hash_cells(self, discrete_samples):
+        """ Index in the hashed table of each tile, for discrete samples with shape (..., tiles, vars) """
+
+        # multiply-shift hash, wrapping around in 64 bits, then mixed so the index depends on all bits
+        keys = discrete_samples.astype(np.uint64) @ self.hash_multipliers + self.hash_tile_keys
+        keys ^= keys >> np.uint64(31)
+        keys *= np.uint64(0x9E3779B97F4A7C15)
+        keys ^= keys >> np.uint64(29)
+
+        return (keys % np.uint64(self.hash_size)).astype(np.int64)
 
 
 class ActionDiscretizer(Discretizer):
@@ -189,6 +497,20 @@ class ActionDiscretizer(Discretizer):
 
         return continuous_sample
 
+    def revert_batch(self, samples):
+        """ Revert several discrete actions at once. Returns an array with one row per action """
+
+        # same positions as vector_to_matrix, one array per var
+        positions = np.unravel_index(np.asarray(samples, dtype=np.int64), self.bin_sizes)
+
+        continuous_samples = np.zeros((len(positions[0]), self.n_vars))
+        for idx, s in enumerate(positions):
+            # edges of all bins, including the environment boundaries
+            edges = np.concatenate([[self.lower_bounds[idx]], self.bins[idx], [self.upper_bounds[idx]]])
+            continuous_samples[:, idx] = np.random.uniform(low=edges[s], high=edges[s + 1])
+
+        return continuous_samples
+
 
 
 # class ImageDiscretizer(Discretizer):
@@ -1,5 +1,6 @@
 from fasterrl.common.wrapper import *
 from fasterrl.common.discretizer import *
+from fasterrl.common.native_env import *
 import numpy as np
 
 # save expected reward and number of episodes
@@ -21,7 +22,7 @@ class BaseEnv():
 
         # initialize environment depending on the platform
         if "PLATFORM" not in params:
-            raise Exception("Please define the paramater PLATFORM. Currently supported plataforms: openai, marlo, gym-minecraft")
+            raise Exception("Please define the paramater PLATFORM. Currently supported plataforms: openai, marlo, gym-minecraft, native")
 
         self.platform = "openai"
         if "PLATFORM" in params:
@@ -45,6 +46,23 @@ class BaseEnv():
             self.env = self.configure_gym_marlo(params["ENV_NAME"])
             self.env = wrap_env_malmo(self.env)
             self.configure_gym()
+        elif self.platform == "native":
+            # numpy versions of the environments, stepping several copies at once
+            self.num_envs = 1
+            if "NUM_ENVS" in params:
+                self.num_envs = params["NUM_ENVS"]
+            self.env = make_native_env(params["ENV_NAME"], self.num_envs)
+            # a single copy has the interface of a gym environment
+            if self.num_envs == 1:
+                self.env = SingleNativeEnv(self.env)
+            self.configure_gym()
+
+        self.configure(params)
+
+    def configure(self, params):
+        """ Handling of observations, actions and rewards, as discretization and reward scaling.
+            Requires the observation and action spaces of the environment
+        """
 
         self.render = False
         if "RENDER" in params:
@@ -89,11 +107,27 @@ class BaseEnv():
             if "TILE_OFFSETS" in params:
                 tile_offsets = params["TILE_OFFSETS"]
 
+            # discrete states as a single int id instead of a tuple, one per tile with tiles
+            flat_states = False
+            if "DISCRETIZE_STATE_FLAT" in params:
+                flat_states = params["DISCRETIZE_STATE_FLAT"]
+
+            # block of pixels averaged into a single var, for image observations
+            reduce_block = None
+            if "DISCRETIZE_STATE_REDUCE_BLOCK" in params:
+                reduce_block = params["DISCRETIZE_STATE_REDUCE_BLOCK"]
+
+            # tiles as indices in a hashed table of fixed size, instead of a table per tile
+            tile_hash_size = None
+            if "TILE_HASH_SIZE" in params:
+                tile_hash_size = params["TILE_HASH_SIZE"]
+
             # initialize discretizer
             if with_tiles:
-                self.state_discretizer = TileDiscretizer(self.observation_space, bin_size, bin_sizes, tile_offsets)
+                self.state_discretizer = TileDiscretizer(self.observation_space, bin_size, bin_sizes, tile_offsets,
+                    flat_states, reduce_block, tile_hash_size)
             else:
-                self.state_discretizer = Discretizer(self.observation_space, bin_size, bin_sizes)
+                self.state_discretizer = Discretizer(self.observation_space, bin_size, bin_sizes, flat_states, reduce_block)
 
             discretize_type = 'unitary'
             if "DISCRETIZE_STATE_TYPE" in params:
@@ -106,10 +140,23 @@ class BaseEnv():
                     self.random_true_sampling(discretize_sampling_size, type='state')
                 if discretize_type == 'false_sampling':
                     self.random_false_sampling(discretize_sampling_size, type='state')
-
-            # change observation space
+                # online bins are refit to the states observed during training, with no upfront sampling
+                if discretize_type == 'online':
+                    refit_interval = 1000
+                    if "DISCRETIZE_STATE_REFIT_INTERVAL" in params:
+                        refit_interval = params["DISCRETIZE_STATE_REFIT_INTERVAL"]
+                    self.state_discretizer.set_online(refit_interval)
+
+            # change observation space. flat and hashed states are in a single dimension, as in a discrete space
             if not self.passive:
-                self.observation_space.shape = tuple(self.state_discretizer.bin_sizes)
+                if with_tiles and tile_hash_size:
+                    self.observation_space.shape = ()
+                    self.observation_space.n = tile_hash_size
+                elif flat_states:
+                    self.observation_space.shape = ()
+                    self.observation_space.n = self.state_discretizer.state_count()
+                else:
+                    self.observation_space.shape = tuple(self.state_discretizer.bin_sizes)
 
         # implements action discretization
         self.discretize_action = False
@@ -175,6 +222,10 @@ class BaseEnv():
             if self.render:
                 self.env.render('human') # specific for minecraft
 
+        # online discretizers learn the bins from every observation, even in passive mode
+        if self.discretize_state and self.state_discretizer.sketch is not None:
+            self.state_discretizer.observe(observation)
+
         # discretize observation, if required
         if self.discretize_state and not self.passive:
             observation = self.state_discretizer.convert(observation)
@@ -239,12 +290,19 @@ class BaseEnv():
     def reset(self):
         observation = self.env.reset()
 
+        # online discretizers learn the bins from every observation, even in passive mode
+        if self.discretize_state and self.state_discretizer.sketch is not None:
+            self.state_discretizer.observe(observation)
+
         # discretize observation, if required
         if self.discretize_state and not self.passive:
             observation = self.state_discretizer.convert(observation)
 
         return observation
 
+    def close(self):
+        pass # release resources held by the environment, such as worker processes
+
     def report_step(self):
         return self.step_vars
 
@@ -258,14 +316,14 @@ class BaseEnv():
         # randomly samples states
         if type == 'state':
             for i in range(count):
-                samples.append(self.env.observation_space.sample())
+                samples.append(self.observation_space.sample())
 
             self.state_discretizer.define_bins_from_samples(samples)
 
         # randomly sample actions
         elif type == 'action':
             for i in range(count):
-                samples.append(self.env.action_space.sample())
+                samples.append(self.action_space.sample())
 
             self.action_discretizer.define_bins_from_samples(samples)
 
@@ -1,6 +1,12 @@
 from fasterrl.agents import *
 from fasterrl.common.logger import *
 from fasterrl.common.environment import *
+from fasterrl.common.vec_env import VecEnv
+from fasterrl.common.actor_learner import *
+from fasterrl.common.shared_buffer import *
+from fasterrl.common.native_env import make_native_env
+from fasterrl.common.buffer import batch_length
+from gym import spaces
 
 import os
 from datetime import datetime
@@ -8,6 +14,7 @@ from time import sleep, time
 import json
 from collections import namedtuple, defaultdict
 import numpy as np
+import torch.multiprocessing
 
 
 AgentExperiment = namedtuple('AgentExperiment', field_names=['env', 'agent', 'logger'])
@@ -44,6 +51,8 @@ class BaseExperiment:
         with open(params_log_path, "w") as f:
             json.dump(params, f)
 
+        self.experiment_id = experiment_id
+
         # log paths, tensorboard agents specifics and trial overall json
         # don't use groups for runs yet until the impact on tensorboard is clear
         # self.log_dir = os.path.join(log_root, "runs", experiment_id)
@@ -80,11 +89,21 @@ class BaseExperiment:
         if "PREFILL_BUFFER" in params:
             self.prefill_buffer = params["PREFILL_BUFFER"]
 
+        # pool of experiences shared by all agents, only used in multiagent experiments
+        self.shared_pool = None
+
         # define methods for agent, env and logger
         self.agent_method = eval(params["METHOD"])
         self.env_method = BaseEnv
         self.logger_method = BaseLogger
 
+        # several copies of the environment are stepped together in a vectorized environment
+        if "NUM_ENVS" in params and params["NUM_ENVS"] > 1:
+            if not self.agent_method.vectorized:
+                raise Exception("Method {} does not support NUM_ENVS > 1, it acts in a single environment".format(
+                    params["METHOD"]))
+            self.env_method = VecEnv
+
         self.exp_logger = ExperimentLogger(local_log_path)
 
         if self.log_level > 1:
@@ -114,8 +133,13 @@ class BaseExperiment:
         # instantiate env, logger and agent for every trial
         env = self.env_method(self.params) # ok
         agent = self.agent_method(self.params) # ok
-        agent.set_environment(env)
+        # alias and run are set first, agents may use them to name local files
         agent.set_alias(alias)
+        agent.set_run(self.experiment_id, trial)
+        # the pool is given before buffers are created. in multiagent experiments, color is the index of the agent
+        if self.shared_pool is not None:
+            agent.set_shared_pool(self.shared_pool, color)
+        agent.set_environment(env)
         logger = self.logger_method(self.params, self.log_dir, agent, trial, color) # ok
 
         if self.prefill_buffer:
@@ -132,11 +156,17 @@ class BaseExperiment:
         for episode in range(self.num_episodes):
             self.run_episode(agent, logger)
         logger.end_training()
+        agent.close()
+        env.close()
 
         return logger.episode_count, np.mean(logger.rewards), np.mean(logger.steps)
 
     def run_episode(self, agent, logger):
 
+        if isinstance(agent.env, VecEnv):
+            self.run_vector_episodes(agent, logger)
+            return
+
         logger.start_episode()
         agent.reset()
         episode_complete = False
@@ -157,6 +187,21 @@ class BaseExperiment:
 
         logger.log_episode()
 
+    def run_vector_episodes(self, agent, logger):
+        """ Step all copies of a vectorized environment until episodes finish in at least one of them.
+
+            Copies start the next episode by themselves, so the environment is only reset at the start of training
+        """
+
+        if logger.total_steps_count == 0:
+            agent.reset()
+
+        logger.start_episode()
+        episodes_finished = 0
+        while not episodes_finished:
+            dones = agent.play_step()
+            episodes_finished = logger.log_vector_step(dones)
+
 class UntilWinExperiment(BaseExperiment):
     """ agent plays until it wins. may define a max number of episodes """
 
@@ -183,11 +228,219 @@ class UntilWinExperiment(BaseExperiment):
         while not logger.is_solved() and logger.episode_count < self.max_episodes:
             self.run_episode(agent, logger)
         logger.end_training()
+        agent.close()
+        env.close()
 
         # can print results here, besides from returning
         return logger.episode_count, np.mean(logger.rewards), np.mean(logger.steps)
 
 
+class BatchedTabularExperiment(UntilWinExperiment):
+    """ Runs many trials of a tabular agent at once, one agent per environment of a native vectorized environment.
+
+        Each trial plays until it wins or reaches the max number of episodes, as in UntilWinExperiment,
+        and trials that finished stop learning while the others continue
+    """
+
+    # batched version of each tabular method
+    BATCHED_METHODS = {
+        "QLearning": BatchedQLearning,
+        "Sarsa": BatchedSarsa,
+    }
+
+    def __init__(self, params, experiment_name=None, experiment_group=None):
+        super(BatchedTabularExperiment, self).__init__(params, experiment_name, experiment_group)
+
+        if params["METHOD"] not in self.BATCHED_METHODS:
+            raise Exception("Method {} has no batched version. Available: {}".format(
+                params["METHOD"], ", ".join(self.BATCHED_METHODS)))
+        self.agent_method = self.BATCHED_METHODS[params["METHOD"]]
+
+        # q-tables are indexed by the observations, which must be discrete. states are not discretized
+        observation_space = make_native_env(params["ENV_NAME"], 1).observation_space
+        if not isinstance(observation_space, spaces.Discrete):
+            raise Exception("Environment {} has a {} observation space, batched tabular methods require a discrete one".format(
+                params["ENV_NAME"], type(observation_space).__name__))
+
+        # number of trials run at once, all by default
+        self.batch_trials = self.num_trials
+        if "BATCH_TRIALS" in params:
+            self.batch_trials = params["BATCH_TRIALS"]
+
+        # required to identify when trials are solved
+        self.mean_reward_bound = params["MEAN_REWARD_BOUND"]
+        self.number_episodes_mean = params["NUMBER_EPISODES_MEAN"]
+
+    def run(self):
+
+        for first_trial in range(0, self.num_trials, self.batch_trials):
+            num_trials = min(self.batch_trials, self.num_trials - first_trial)
+            t0 = time()
+            results = self.run_batch(num_trials)
+
+            # time is split equally between trials run together
+            time_spent = (time() - t0) / num_trials
+            for episodes, avg_reward, avg_steps in results:
+                self.exp_logger.update(time_spent, episodes, avg_reward, avg_steps)
+
+            if self.log_level > 1:
+                print("Trials {} to {} took {:.2f} seconds".format(first_trial, first_trial + num_trials - 1, time() - t0))
+
+        # print to screen
+        if self.log_level > 1:
+            self.exp_logger.report()
+            self.exp_logger.save()
+
+        return np.mean(self.exp_logger.episodes_to_complete)
+
+    def run_batch(self, num_trials):
+        """ Run trials together until all are complete. Returns episodes, average reward and average steps of each """
+
+        env = make_native_env(self.params["ENV_NAME"], num_trials)
+        agent = self.agent_method(self.params)
+        agent.set_environment(env)
+        agent.reset()
+
+        episode_rewards = np.zeros(num_trials)
+        episode_steps = np.zeros(num_trials, dtype=np.int64)
+        rewards = [[] for _ in range(num_trials)]
+        steps = [[] for _ in range(num_trials)]
+        completed = np.zeros(num_trials, dtype=bool)
+
+        while not completed.all():
+            dones = agent.play_step()
+            episode_rewards += agent.step_reward
+            episode_steps += 1
+
+            # episodes end for a few trials at a time, so are logged one by one
+            for trial in np.flatnonzero(dones & ~completed):
+                rewards[trial].append(episode_rewards[trial])
+                steps[trial].append(episode_steps[trial])
+                episode_count = len(rewards[trial])
+                solved = episode_count >= self.number_episodes_mean and \
+                    np.mean(rewards[trial][-self.number_episodes_mean:]) >= self.mean_reward_bound
+                if solved or episode_count >= self.max_episodes:
+                    completed[trial] = True
+
+            episode_rewards[dones] = 0
+            episode_steps[dones] = 0
+            agent.active = ~completed
+
+        agent.close()
+
+        return [(len(rewards[trial]), np.mean(rewards[trial]), np.mean(steps[trial])) for trial in range(num_trials)]
+
+class ActorLearnerExperiment(UntilWinExperiment):
+    """ DQN with acting and learning decoupled, as in UntilWinExperiment.
+
+        Actor processes play their own environments with copies of the network and stream experiences in chunks
+        to the learner, the experiment process, which owns the replay buffer and optimizer.
+        The learner adds the experiences received and runs gradient updates continuously, publishing its weights
+        every WEIGHTS_PUBLISH_UPDATES updates. Actors pull them every ACTOR_SYNC_STEPS steps.
+
+        Backpressure: the queue holds at most ACTOR_QUEUE_SIZE chunks, actors wait while it is full.
+        If UPDATE_TO_DATA_RATIO is given, the learner also waits for experiences when ahead of the ratio.
+        Unlike in DQN, where it defaults to one update per experience, here the ratio is only a limit,
+        and the learner runs updates as fast as it can if it is not given.
+
+        Each actor plays a single environment, use NUM_ACTORS instead of NUM_ENVS
+    """
+
+    def __init__(self, params, experiment_name=None, experiment_group=None):
+        super(ActorLearnerExperiment, self).__init__(params, experiment_name, experiment_group)
+
+        if "NUM_ENVS" in params and params["NUM_ENVS"] > 1:
+            raise Exception("ActorLearnerExperiment does not support NUM_ENVS > 1, use NUM_ACTORS to play more environments")
+
+        self.num_actors = 2
+        if "NUM_ACTORS" in params:
+            self.num_actors = params["NUM_ACTORS"]
+
+        self.actor_queue_size = 16
+        if "ACTOR_QUEUE_SIZE" in params:
+            self.actor_queue_size = params["ACTOR_QUEUE_SIZE"]
+
+        self.weights_publish_updates = 50
+        if "WEIGHTS_PUBLISH_UPDATES" in params:
+            self.weights_publish_updates = params["WEIGHTS_PUBLISH_UPDATES"]
+
+        # maximum gradient updates per experience received. None to learn with no limit,
+        # unlike in DQN, where a missing ratio means one update per experience
+        self.update_to_data_ratio = None
+        if "UPDATE_TO_DATA_RATIO" in params:
+            self.update_to_data_ratio = params["UPDATE_TO_DATA_RATIO"]
+
+        # start method of the actor processes, platform default if None
+        self.actor_start_method = None
+        if "ACTOR_START_METHOD" in params:
+            self.actor_start_method = params["ACTOR_START_METHOD"]
+
+    def run_trial(self, trial):
+
+        env, agent, logger = self.init_instances(trial)
+
+        context = torch.multiprocessing.get_context(self.actor_start_method)
+        transitions = context.Queue(maxsize=self.actor_queue_size)
+        episodes = context.Queue()
+        stop = context.Event()
+        weights = SharedWeights(agent.net, context)
+
+        actors = []
+        for actor_index in range(self.num_actors):
+            actor = context.Process(target=run_actor,
+                args=(self.params, actor_index, weights, transitions, episodes, stop), daemon=True)
+            actor.start()
+            actors.append(actor)
+
+        logger.start_training()
+        logger.start_episode()
+        experiences, updates = 0, 0
+        try:
+            while not logger.is_solved() and logger.episode_count < self.max_episodes:
+
+                # failed actors send nothing, the learner would wait for them or learn from a stale buffer forever
+                check_actors(actors)
+
+                # wait for experiences if there are not enough to learn, or if learning is ahead of the ratio
+                needs_data = len(agent.buffer) <= agent.replay_batch_size
+                if self.update_to_data_ratio is not None:
+                    needs_data = needs_data or updates >= experiences * self.update_to_data_ratio
+
+                # with a ratio, experiences are only taken when the updates for the previous ones are done,
+                # so actors wait on the full queue while the learner is behind
+                if needs_data or self.update_to_data_ratio is None:
+                    for chunk in get_available(transitions, wait=needs_data):
+                        agent.buffer.receive(chunk)
+                        num_experiences = batch_length(chunk)
+                        experiences += num_experiences
+                        logger.total_steps_count += num_experiences
+                        # target network and priorities follow the experiences received
+                        agent.update_params(num_experiences)
+                        agent.checkpoint_episodes(int(np.sum(chunk[3])))
+
+                for _, episode_reward, steps_count in get_available(episodes):
+                    logger.log_episode_result(episode_reward, steps_count)
+
+                if not needs_data:
+                    agent.train_step()
+                    updates += 1
+                    if updates % self.weights_publish_updates == 0:
+                        weights.publish(agent.net)
+
+        finally:
+            # actors waiting on a full queue see the stop and exit
+            stop.set()
+            for actor in actors:
+                actor.join(timeout=5)
+                if actor.is_alive():
+                    actor.terminate()
+
+        logger.end_training()
+        agent.close()
+        env.close()
+
+        return logger.episode_count, np.mean(logger.rewards), np.mean(logger.steps)
+
 class MultiAgentExperiment(UntilWinExperiment):
     """ Two or more agents plays sequentially
         Modifications are done only to run and run trial functions
@@ -214,6 +467,14 @@ class MultiAgentExperiment(UntilWinExperiment):
             if "SHARE_BATCH_SIZE" in self.params:
                 self.share_batch_size = self.params["SHARE_BATCH_SIZE"]
 
+        # keep experiences of all agents once in shared memory, agents share only positions in the pool
+        self.shared_replay = False
+        if "SHARED_REPLAY" in self.params:
+            self.shared_replay = self.params["SHARED_REPLAY"]
+        if self.shared_replay and not hasattr(self.agent_method, "set_shared_pool"):
+            raise Exception("SHARED_REPLAY requires a method with a replay buffer, such as DQN. Method {} has none".format(
+                self.params["METHOD"]))
+
         if self.focused_sharing:
             self.sharing = False # turn of regular sharing, one or the other
             self.focused_sharing_threshold = 3
@@ -254,6 +515,13 @@ class MultiAgentExperiment(UntilWinExperiment):
 
         agents = []
 
+        # pool is sized to hold the buffers of all agents
+        if self.shared_replay:
+            experience_buffer_size = 1000
+            if "EXPERIENCE_BUFFER_SIZE" in self.params:
+                experience_buffer_size = self.params["EXPERIENCE_BUFFER_SIZE"]
+            self.shared_pool = SharedExperiencePool(self.num_agents, experience_buffer_size, np.float32)
+
         # initialize all agents
         for idx_a in range(self.num_agents):
             agents.append(self.init_instances(trial, alias="agent"+str(idx_a), color=idx_a))
@@ -282,6 +550,12 @@ class MultiAgentExperiment(UntilWinExperiment):
         # end training
         for a in agents:
             a.logger.end_training()
+            a.agent.close()
+            a.env.close()
+
+        if self.shared_pool is not None:
+            self.shared_pool.close()
+            self.shared_pool = None
 
         return [(a.logger.episode_count, np.mean(a.logger.rewards), np.mean(a.logger.steps), a.logger.experiences_received) for a in agents]
 
@@ -296,7 +570,11 @@ class MultiAgentExperiment(UntilWinExperiment):
 
         # select experiences to share
         for a in agents:
-            transfer_batch = a.agent.buffer.select_batch(self.share_batch_size)
+            if self.shared_replay:
+                # only positions in the shared pool are exchanged
+                transfer_batch = a.agent.buffer.select_shared(self.share_batch_size)
+            else:
+                transfer_batch = a.agent.buffer.select_batch(self.share_batch_size)
             transfer_batches.append(transfer_batch)
 
         # receive experiences from all other agents
@@ -306,8 +584,12 @@ class MultiAgentExperiment(UntilWinExperiment):
                 batch_indices = list(range(len(agents)))
                 batch_indices.pop(idx_a) # agent should not receive his own experiences
                 for idx_b in batch_indices:
-                    a.agent.buffer.receive(transfer_batches[idx_b])
-                    a.logger.experiences_received += len(transfer_batches[idx_b])
+                    if self.shared_replay:
+                        # experiences the agent already has are skipped
+                        a.logger.experiences_received += a.agent.buffer.receive_shared(transfer_batches[idx_b])
+                    else:
+                        a.agent.buffer.receive(transfer_batches[idx_b])
+                        a.logger.experiences_received += len(transfer_batches[idx_b])
 
         if self.log_level > 4:
             print("Number of experiences transferred: {}".format([len(tb) for tb in transfer_batches]))
@@ -346,8 +628,9 @@ class MultiAgentExperiment(UntilWinExperiment):
             if not a.agent.completed:
                 for batch in batches:
                     a.agent.buffer.receive(batch)
-                    a.logger.experiences_received += len(batch)
-                    num_experiences_received += len(batch)
+                    # batches are given as one array per field
+                    a.logger.experiences_received += batch_length(batch)
+                    num_experiences_received += batch_length(batch)
             tb_sizes.append(num_experiences_received)
 
         # removed tb sizes - replaced by logger
@@ -33,3 +33,32 @@ class OUNoise:
         self.state = x + dx
         return self.state
 
+
+def greedy_mask(qvalues):
+    """ Mask of the actions with the maximum value, along the last axis. Works on a single state or a batch """
+
+    qvalues = np.asarray(qvalues)
+    return qvalues == qvalues.max(axis=-1, keepdims=True)
+
+def greedy_probabilities(qvalues):
+    """ Probability of each action in the greedy policy, with ties broken at random """
+
+    mask = greedy_mask(qvalues)
+    return mask / mask.sum(axis=-1, keepdims=True)
+
+def greedy_action(qvalues):
+    """ Action with the maximum value, chosen at random among ties.
+
+        For a batch of states, returns an array with the action of each state
+    """
+
+    qvalues = np.asarray(qvalues)
+    if qvalues.ndim == 1:
+        best_actions = np.flatnonzero(qvalues == qvalues.max())
+        if len(best_actions) == 1:
+            return int(best_actions[0])
+        return int(best_actions[np.random.randint(len(best_actions))])
+
+    # a random priority among the maxima of each state, so ties are broken uniformly
+    priorities = np.where(greedy_mask(qvalues), np.random.rand(*qvalues.shape), -1.)
+    return priorities.argmax(axis=-1)
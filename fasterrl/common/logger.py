@@ -111,6 +111,10 @@ class BaseLogger():
         self.rewards = []
         self.steps = []
 
+        # reward and steps of the current episode of each copy, with vectorized environments
+        self.vector_rewards = None
+        self.vector_steps = None
+
         # time
         self.trial_start = time()
 
@@ -152,6 +156,40 @@ class BaseLogger():
 
             self.step_start = time()
 
+    def log_vector_step(self, dones):
+        """ Log a step of all copies of a vectorized environment, and the episodes that finished in it.
+            Returns the number of episodes finished
+        """
+
+        # convert rewards back to original scale
+        rewards = np.asarray(self.agent.step_reward, dtype=np.float64)
+        if self.reward_scaling_factor:
+            rewards = rewards / self.reward_scaling_factor
+
+        if self.vector_rewards is None:
+            self.vector_rewards = np.zeros(len(rewards))
+            self.vector_steps = np.zeros(len(rewards), dtype=np.int64)
+
+        self.total_steps_count += len(rewards)
+        self.vector_rewards += rewards
+        self.vector_steps += 1
+
+        # episodes of different copies end at different steps, so are logged one by one
+        finished = np.flatnonzero(dones)
+        for copy in finished:
+            self.log_episode_result(self.vector_rewards[copy], int(self.vector_steps[copy]))
+        self.vector_rewards[finished] = 0
+        self.vector_steps[finished] = 0
+
+        return len(finished)
+
+    def log_episode_result(self, episode_reward, steps_count):
+        """ Log an episode played outside of log_step, as by actor processes. Reward in the original scale """
+
+        self.episode_reward = episode_reward
+        self.steps_count = steps_count
+        self.log_episode()
+
     def log_episode(self):
 
         episode_speed = time() - self.episode_start
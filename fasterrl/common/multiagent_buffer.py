@@ -1,15 +1,40 @@
+import numpy as np
 from fasterrl.common.buffer import *
+from fasterrl.common.buffer import write_array, read_arrays, batch_length
+
+# grids with more cells than this keep occupancy only for the cells visited
+DENSE_GRID_LIMIT = 2 ** 24
+
+
+class SparseGridMask:
+    """ Mask over a sparse grid. Selects every cell except the ones given, so unvisited cells are always selected """
+
+    def __init__(self, excluded_cells):
+
+        self.excluded_cells = np.asarray(excluded_cells, dtype=np.int64)
+
+    def selects(self, cells):
+        """ Whether each of the flat cells given is selected """
+
+        return ~np.isin(cells, self.excluded_cells)
+
 
 class ExperienceBufferGrid(ExperienceBuffer):
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, storage=None):
 
-        # uses a list instead
-        self.buffer = []
+        # uses a list instead, or the storage given
+        self.buffer = [] if storage is None else storage
         self.capacity = capacity
-        self.pos = 0
+        # storage may be reopened with experiences in it
+        self.pos = 0 if storage is None else storage.count % self.capacity
 
-    def set_grid(self, discretizer, action_size, with_tiles=False):
+    def set_grid(self, discretizer, action_size, with_tiles=False, sparse=None):
+        """ Grid over discretized states and actions, counting the experiences in each cell
+
+            - sparse: keep occupancy only for the cells visited, in a dict keyed by the flat cell.
+            If None, used when the grid has more than DENSE_GRID_LIMIT cells
+        """
 
         # save reference to discretizer
         self.discretizer = discretizer
@@ -19,73 +44,182 @@ class ExperienceBufferGrid(ExperienceBuffer):
         # need to ensure these are from the discretization, not the original environment
         # add the with tiles option here
         grid_size = tuple(discretizer.bin_sizes)+(action_size,)
+        num_tiles = 1
         if self.with_tiles:
             num_tiles = discretizer.tiles_count()
             grid_size = (num_tiles,) + grid_size
 
-        # initialize experiences grid
-        self.grid_experiences = np.full(grid_size, list)
-        if not self.with_tiles:
-            for pos in self.discretizer.calculate_grid_positions(action_size):
-                self.grid_experiences[pos] = []
-        # for tiles, need to add an extra dimension
+        self.grid_size = grid_size
+        num_cells = np.prod(grid_size, dtype=np.float64)
+        if num_cells >= 2 ** 63:
+            raise Exception("Grid with {:.0e} cells can't be indexed, reduce the number of bins".format(num_cells))
+
+        self.sparse = sparse
+        if self.sparse is None:
+            self.sparse = num_cells > DENSE_GRID_LIMIT
+
+        # initialize occupancy grid, for faster access. unvisited cells are not kept in the sparse grid
+        if self.sparse:
+            self.sparse_occupancy = {}
+        else:
+            self.grid_occupancy = np.zeros(grid_size, dtype=np.int32)
+
+        # flat cell is the flat id of the discrete state times the number of actions, plus action and tile offsets
+        self.action_size = action_size
+        self.tile_offsets = np.zeros(1, dtype=np.int64)
+        if self.with_tiles:
+            self.tile_offsets = np.arange(num_tiles) * (discretizer.state_count() * action_size)
+
+        # flat position in the grid of the experience in each position of the buffer, one column per tile
+        # -1 for positions not written yet
+        self.cells = np.full((self.capacity, num_tiles), -1, dtype=np.int64)
+
+        # experiences already in a reopened storage are added to the grid
+        self.fill_grid()
+
+        # cells change when the bins of an online discretizer are refit
+        discretizer.add_refit_listener(self.refit_grid)
+
+    def fill_grid(self, cells=None):
+        """ Add all experiences in the buffer to an empty grid.
+
+            cells, as returned by grid_cells, gives the position of each experience,
+            so states don't need to be discretized again
+        """
+
+        size = len(self.buffer)
+        if size == 0:
+            return
+
+        if cells is None:
+            states, actions = self.take(np.arange(size))[:2]
+            cells = self.get_cells(states, actions)
+
+        self.add_cells(cells, np.arange(size))
+
+    def grid_cells(self):
+        """ Flat position in the grid of each experience, with one column per tile """
+
+        return self.cells[:len(self.buffer)]
+
+    def refit_grid(self, var_maps=None):
+        """ Place experiences again in the grid, after the bins of the discretizer changed """
+
+        # states are kept in the buffer, so are discretized again instead of remapped
+        self.clear_grid()
+        self.fill_grid()
+
+    def clear_grid(self):
+
+        self.cells[:] = -1
+        if self.sparse:
+            self.sparse_occupancy = {}
         else:
-            for t in range(num_tiles):
-                for pos in self.discretizer.calculate_grid_positions(action_size):
-                    pos = (t,) + pos
-                    self.grid_experiences[pos] = []
+            self.grid_occupancy[:] = 0
+
+    def update_occupancy(self, cells, increment):
+        """ Add increment to the occupancy of each cell, once for each time the cell appears """
 
-        # initialize occupancy grid, for faster access
-        self.grid_occupancy = np.zeros(grid_size, dtype=np.int32)
+        if not self.sparse:
+            np.add.at(self.grid_occupancy.reshape(-1), np.asarray(cells).ravel(), increment)
+            return
+
+        cells, counts = np.unique(cells, return_counts=True)
+        for cell, count in zip(cells.tolist(), (counts * increment).tolist()):
+            occupancy = self.sparse_occupancy.get(cell, 0) + count
+            if occupancy:
+                self.sparse_occupancy[cell] = occupancy
+            else:
+                del self.sparse_occupancy[cell]
 
     def get_position(self, experience):
         """ Calculate position in grid for a given experience """
 
-        state = self.discretizer.convert(experience.state)
-        action = experience.action
+        position = np.unravel_index(self.experience_cells(experience), self.grid_size)
         if not self.with_tiles:
-            position = state + (action, )
-        else:
-            # in tiles, position is an array of tuples instead of a single tuple
-            position = [s + (action, ) for s in state]
+            return tuple([int(p[0]) for p in position])
 
-        return position
+        # in tiles, position is an array of tuples instead of a single tuple
+        return [tuple(p) for p in np.array(position).T.tolist()]
+
+    def experience_cells(self, experience):
+        """ Flat position in the grid of a single experience, one per tile """
+
+        # flat ids of the state, regardless of the output of the discretizer. one per tile with tiles
+        state_ids = np.asarray(self.discretizer.convert_flat(experience.state), dtype=np.int64)
+
+        return state_ids * self.action_size + experience.action + self.tile_offsets
+
+    def get_cells(self, states, actions):
+        """ Flat position in the grid of a batch of experiences, with one column per tile """
+
+        # flat ids of the states have shape (experiences,), or (experiences, tiles) with tiles
+        state_ids = self.discretizer.convert_batch(states, flat=True)
+        actions = np.asarray(actions, dtype=np.int64)
+
+        if not self.with_tiles:
+            state_ids = state_ids[:, None]
+
+        return state_ids * self.action_size + actions[:, None] + self.tile_offsets
+
+    def write_batch(self, experiences):
+        """ Write the batch in the ring and update the grid, with all states discretized in a single call """
+
+        # cells of the experiences overwritten are already known
+        num_before = len(self.buffer)
+        positions = (self.pos + np.arange(batch_length(experiences))) % self.capacity
+        self.remove_cells(positions[positions < num_before])
+
+        positions = super(ExperienceBufferGrid, self).write_batch(experiences)
+        if len(positions) > 0:
+            states, actions = self.take(positions)[:2]
+            self.add_cells(self.get_cells(states, actions), positions)
+
+        return positions
+
+    def remove_cells(self, positions):
+        """ Remove the experiences in the given positions from the grid """
+
+        self.update_occupancy(self.cells[positions], -1)
+        self.cells[positions] = -1
+
+    def add_cells(self, cells, positions):
+        """ Add the experiences in the given positions to the given cells """
+
+        self.cells[positions] = cells
+        self.update_occupancy(cells, 1)
 
     def identify_unexplored(self, threshold):
 
+        # in the sparse grid, mask is given by the cells explored, all others are unexplored
+        if self.sparse:
+            return SparseGridMask([cell for cell, occupancy in self.sparse_occupancy.items() if occupancy > threshold])
+
         mask = self.grid_occupancy <= threshold
         return mask
 
-    def remove_from_grid(self, removed_experience):
+    def remove_from_grid(self, pos):
 
-        position_old = self.get_position(removed_experience)
-        if not self.with_tiles:
-            # remove from grid - will always be the first to be added
-            self.grid_experiences[position_old].pop(0)
-            # remove from count
-            self.grid_occupancy[position_old] -= 1
+        # cells of a single experience are all different, one per tile, so they can be updated with indexing
+        if self.sparse:
+            self.update_occupancy(self.cells[pos], -1)
         else:
-            # remove for all tiles
-            for idx, state in enumerate(position_old):
-                tile_state = (idx,) + state
-                self.grid_experiences[tile_state].pop(0)
-                self.grid_occupancy[tile_state] -= 1
+            self.grid_occupancy.reshape(-1)[self.cells[pos]] -= 1
+        self.cells[pos] = -1
 
+    def add_to_grid(self, experience, pos=None):
 
-    def add_to_grid(self, experience):
+        # by default experience is the one being written in the current position
+        if pos is None:
+            pos = self.pos
 
-        position_new = self.get_position(experience)
-        if not self.with_tiles:
-            self.grid_experiences[position_new].append((experience, self.pos))
-            # add to counter
-            self.grid_occupancy[position_new] += 1
-        else:
-            # update for all tiles
-            for idx, state in enumerate(position_new):
-                tile_state = (idx,) + state
-                self.grid_experiences[tile_state].append((experience, self.pos))
-                self.grid_occupancy[tile_state] += 1
+        cells = self.experience_cells(experience)
 
+        self.cells[pos] = cells
+        if self.sparse:
+            self.update_occupancy(cells, 1)
+        else:
+            self.grid_occupancy.reshape(-1)[cells] += 1
 
     def append(self, experience):
         """ Adds to grid as well as appending to buffer. Remove if buffer full """
@@ -95,10 +229,8 @@ class ExperienceBufferGrid(ExperienceBuffer):
             # if buffer not full, append new transition
             self.buffer.append(experience)
         else:
-            # identify experience to remove
-            experience_to_delete = self.buffer[self.pos]
-            # remove from the grid
-            self.remove_from_grid(experience_to_delete)
+            # remove the experience in the position from the grid
+            self.remove_from_grid(self.pos)
             # overwrite last position
             self.buffer[self.pos] = experience
 
@@ -109,50 +241,86 @@ class ExperienceBufferGrid(ExperienceBuffer):
         # adjust position - when ends, goes back to zero
         self.pos = (self.pos + 1) % self.capacity
 
+    def select_positions_with_mask(self, mask):
+        """ Positions in the buffer of experiences in the cells selected by the mask.
+
+            With tiles, an experience is repeated for each of its tiles in the mask
+        """
+
+        cells = self.grid_cells()
+        if isinstance(mask, SparseGridMask):
+            selected = mask.selects(cells)
+        else:
+            selected = mask.reshape(-1)[cells]
+        positions, _ = np.nonzero(selected)
+
+        return positions
 
     def select_batch_with_mask(self, batch_size, mask):
         """ Sample from experience batch based on predetermined rules.
         Main 'meat' from the class is in this method """
 
         # filter only relevant experiences
-        selected_experiences = reduce(lambda x,y: x+y, list(self.grid_experiences[mask]))
+        selected_positions = self.select_positions_with_mask(mask)
 
         # pick random experiences in buffer, with no replacement
-        selected_batch_size = min(batch_size, len(selected_experiences))
+        selected_batch_size = min(batch_size, len(selected_positions))
 
         # only proceed if batch size is greater than 0
         if selected_batch_size > 0:
             # select indices
-            indices = np.random.choice(len(selected_experiences), selected_batch_size, replace=False)
-            # added [0] to get experience out of tuple
-            return [selected_experiences[idx][0] for idx in indices]
+            indices = np.random.choice(len(selected_positions), selected_batch_size, replace=False)
+            # batch is returned as one array per field, received in a single write
+            return self.take(selected_positions[indices])
 
         # else return an empty array to standardize output
         else:
             return []
 
+    def save_state(self, path):
+
+        header = super(ExperienceBufferGrid, self).save_state(path)
+        header["pos"] = self.pos
+        if hasattr(self, "cells"):
+            header["grid_shape"] = list(self.grid_size)
+            write_array(path, "grid_cells", self.grid_cells())
+
+        return header
+
+    def load_state(self, path, header, mmap=False):
+        super(ExperienceBufferGrid, self).load_state(path, header, mmap)
+
+        self.pos = header["pos"]
+
+        # if the grid is not set yet, experiences are added when it is
+        if hasattr(self, "cells"):
+            self.clear_grid()
+            # saved positions are only valid for a grid with the same shape
+            if header.get("grid_shape") == list(self.grid_size):
+                self.fill_grid(read_arrays(path, ["grid_cells"])[0])
+            else:
+                self.fill_grid()
+
 class PrioExperienceBufferGrid(PrioReplayBuffer, ExperienceBufferGrid):
 
     def append(self, experience):
 
         # set experience to maximum priority when it enter the buffer
-        max_prio = self.priorities.max() if self.buffer else 1.0
+        max_prio = self.max_priority()
 
         if len(self.buffer) < self.capacity:
             # if buffer not full, append new transition
             self.buffer.append(experience)
         else:
-            # otherwise overwrite last position
-            experience_to_delete = self.buffer[self.pos]
+            # otherwise remove the experience in the position from the grid
+            self.remove_from_grid(self.pos)
             # rewrites the new
             self.buffer[self.pos] = experience
-            # calculate position
-            self.remove_from_grid(experience_to_delete)
 
         self.add_to_grid(experience)
 
         # set priorities
-        self.priorities[self.pos] = max_prio
+        self.set_priority(self.pos, max_prio)
         # adjust position - when ends, goes back to zero
         self.pos = (self.pos + 1) % self.capacity
 
@@ -161,24 +329,24 @@ class PrioExperienceBufferGrid(PrioReplayBuffer, ExperienceBufferGrid):
         Main 'meat' from the class is in this method """
 
         # filter only relevant experiences
-        selected_experiences = reduce(lambda x,y: x+y, list(self.grid_experiences[mask]))
-        selected_batch_size = min(batch_size, len(selected_experiences))
+        selected_positions = self.select_positions_with_mask(mask)
+        selected_batch_size = min(batch_size, len(selected_positions))
 
         if selected_batch_size > 0:
-            # now I have a way to g
-            indices = [exp[1] for exp in selected_experiences]
-            prios = np.array(self.priorities)[indices]
+            prios = self.priorities[selected_positions]
 
             # do I need this operation just for sampling? not sure, check later
             probs = prios ** self.prob_alpha
             probs /= probs.sum()
 
             # with probabilities, sample from selected experiences
-            final_indices = np.random.choice(len(selected_experiences), batch_size, p=probs)
-            return [selected_experiences[idx][0] for idx in final_indices]
+            final_indices = np.random.choice(len(selected_positions), batch_size, p=probs)
+            return self.take(selected_positions[final_indices])
 
         else:
             return []
 
+class SumTreePrioExperienceBufferGrid(SumTreePrioReplayBuffer, PrioExperienceBufferGrid):
+    """ Prioritized grid buffer using sum and min trees for sampling and priority updates """
 
-
+    pass
@@ -0,0 +1,356 @@
+"""
+    Environments implemented in NumPy, stepping several independent copies at once
+
+"""
+
+import numpy as np
+from gym import spaces
+
+__all__ = [
+    "NativeVectorEnv",
+    "VectorFrozenLake",
+    "VectorCartPole",
+    "VectorAcrobot",
+    "SingleNativeEnv",
+    "NATIVE_ENVS",
+    "make_native_env"
+]
+
+FROZEN_LAKE_MAPS = {
+    "4x4": [
+        "SFFF",
+        "FHFH",
+        "FFFH",
+        "HFFG"
+    ],
+    "8x8": [
+        "SFFFFFFF",
+        "FFFFFFFF",
+        "FFFHFFFF",
+        "FFFFFHFF",
+        "FFFHFFFF",
+        "FHHFFFHF",
+        "FHFFHFHF",
+        "FFFHFFFG"
+    ],
+}
+
+
+class NativeVectorEnv:
+    """ Several copies of an environment, stepped at once with array operations.
+
+        Environments that finish an episode are reset in the same step, and the observation returned is the initial one.
+        The last observation of the episode is kept in the info, under final_observations.
+        Episodes also finish after max_episode_steps, as in the gym time limit.
+
+        Subclasses implement reset_envs, transition and observe
+    """
+
+    def __init__(self, num_envs, max_episode_steps):
+
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+
+    def reset(self):
+
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        self.steps[:] = 0
+
+        return self.observe()
+
+    def step(self, actions):
+        """ Step all environments. Returns arrays with the observation, reward and done of each environment """
+
+        rewards, terminated = self.transition(np.asarray(actions))
+        self.steps += 1
+        dones = terminated | (self.steps >= self.max_episode_steps)
+
+        observations = self.observe()
+        final_observations = observations
+        # finished environments start the next episode
+        if dones.any():
+            self.reset_envs(dones)
+            self.steps[dones] = 0
+            observations = self.observe()
+
+        return observations, rewards, dones, {"final_observations": final_observations}
+
+    def reset_envs(self, mask):
+        """ Set the initial state of the environments in the mask """
+
+        raise NotImplementedError
+
+    def transition(self, actions):
+        """ Apply the actions. Returns the reward of each environment and whether it reached a terminal state """
+
+        raise NotImplementedError
+
+    def observe(self):
+
+        raise NotImplementedError
+
+
+class VectorFrozenLake(NativeVectorEnv):
+    """ Several FrozenLake environments, with the same dynamics as gym FrozenLakeEnv """
+
+    # moves of the actions left, down, right and up, in rows and columns
+    MOVES = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+
+    def __init__(self, num_envs, desc=None, map_name="4x4", is_slippery=True, max_episode_steps=100):
+        super(VectorFrozenLake, self).__init__(num_envs, max_episode_steps)
+
+        self.is_slippery = is_slippery
+
+        desc = np.array([list(row) for row in (desc or FROZEN_LAKE_MAPS[map_name])])
+        nrows, ncols = desc.shape
+        num_states = nrows * ncols
+        num_actions = len(self.MOVES)
+
+        self.observation_space = spaces.Discrete(num_states)
+        self.action_space = spaces.Discrete(num_actions)
+
+        cells = desc.ravel()
+        self.start_state = int(np.flatnonzero(cells == "S")[0])
+        self.goal = cells == "G"
+        self.terminal = (cells == "G") | (cells == "H")
+
+        # next state of each state and action, for each of the three directions the agent may slip to
+        # slipping goes to the direction before or after the action, with equal probability
+        rows, cols = np.divmod(np.arange(num_states), ncols)
+        self.next_states = np.zeros((num_states, num_actions, 3), dtype=np.int64)
+        for action in range(num_actions):
+            for slip in range(3):
+                move_row, move_col = self.MOVES[(action + slip - 1) % num_actions]
+                next_rows = np.clip(rows + move_row, 0, nrows - 1)
+                next_cols = np.clip(cols + move_col, 0, ncols - 1)
+                self.next_states[:, action, slip] = next_rows * ncols + next_cols
+        # no moves from terminal states
+        self.next_states[self.terminal] = np.flatnonzero(self.terminal)[:, None, None]
+
+        self.states = np.full(num_envs, self.start_state, dtype=np.int64)
+
+    def reset_envs(self, mask):
+
+        self.states[mask] = self.start_state
+
+    def transition(self, actions):
+
+        # without slipping, the action is always the intended one
+        if self.is_slippery:
+            slips = np.random.randint(3, size=self.num_envs)
+        else:
+            slips = 1
+
+        self.states = self.next_states[self.states, actions, slips]
+
+        return self.goal[self.states].astype(np.float64), self.terminal[self.states]
+
+    def observe(self):
+
+        return self.states.copy()
+
+
+class VectorCartPole(NativeVectorEnv):
+    """ Several CartPole environments, with the same dynamics as gym CartPoleEnv """
+
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    # actually half the pole's length
+    length = 0.5
+    polemass_length = masspole * length
+    force_mag = 10.0
+    # seconds between state updates
+    tau = 0.02
+
+    # angle at which to fail the episode
+    theta_threshold_radians = 12 * 2 * np.pi / 360
+    x_threshold = 2.4
+
+    def __init__(self, num_envs, max_episode_steps=200):
+        super(VectorCartPole, self).__init__(num_envs, max_episode_steps)
+
+        # limits are twice the thresholds, so failing observations are still within bounds
+        high = np.array([self.x_threshold * 2, np.finfo(np.float32).max, self.theta_threshold_radians * 2,
+            np.finfo(np.float32).max], dtype=np.float32)
+        self.observation_space = spaces.Box(-high, high, dtype=np.float32)
+        self.action_space = spaces.Discrete(2)
+
+        # one row per environment, with x, x_dot, theta and theta_dot
+        self.state = np.zeros((num_envs, 4))
+
+    def reset_envs(self, mask):
+
+        self.state[mask] = np.random.uniform(low=-0.05, high=0.05, size=(mask.sum(), 4))
+
+    def transition(self, actions):
+
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.polemass_length * theta_dot ** 2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta ** 2 / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        # euler integration
+        self.state = np.stack([
+            x + self.tau * x_dot,
+            x_dot + self.tau * xacc,
+            theta + self.tau * theta_dot,
+            theta_dot + self.tau * thetaacc], axis=1)
+
+        x, theta = self.state[:, 0], self.state[:, 2]
+        terminated = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold_radians)
+
+        # reward is given in every step, including the one that fails
+        return np.ones(self.num_envs), terminated
+
+    def observe(self):
+
+        return self.state.astype(np.float32)
+
+
+class VectorAcrobot(NativeVectorEnv):
+    """ Several Acrobot environments, with the same dynamics as gym AcrobotEnv, in its book version """
+
+    dt = 0.2
+
+    link_length_1 = 1.0
+    link_mass_1 = 1.0
+    link_mass_2 = 1.0
+    # position of the center of mass of each link
+    link_com_pos_1 = 0.5
+    link_com_pos_2 = 0.5
+    # moments of inertia of each link
+    link_moi = 1.0
+
+    max_vel_1 = 4 * np.pi
+    max_vel_2 = 9 * np.pi
+
+    avail_torque = np.array([-1.0, 0.0, +1])
+
+    def __init__(self, num_envs, max_episode_steps=500):
+        super(VectorAcrobot, self).__init__(num_envs, max_episode_steps)
+
+        high = np.array([1.0, 1.0, 1.0, 1.0, self.max_vel_1, self.max_vel_2], dtype=np.float32)
+        self.observation_space = spaces.Box(-high, high, dtype=np.float32)
+        self.action_space = spaces.Discrete(3)
+
+        # one row per environment, with both angles and angular velocities
+        self.state = np.zeros((num_envs, 4))
+
+    def reset_envs(self, mask):
+
+        self.state[mask] = np.random.uniform(low=-0.1, high=0.1, size=(mask.sum(), 4))
+
+    def dsdt(self, state, torque):
+        """ Derivative of the state of all environments """
+
+        m1 = self.link_mass_1
+        m2 = self.link_mass_2
+        l1 = self.link_length_1
+        lc1 = self.link_com_pos_1
+        lc2 = self.link_com_pos_2
+        I1 = self.link_moi
+        I2 = self.link_moi
+        g = 9.8
+
+        theta1, theta2, dtheta1, dtheta2 = state.T
+        d1 = m1 * lc1 ** 2 + m2 * (l1 ** 2 + lc2 ** 2 + 2 * l1 * lc2 * np.cos(theta2)) + I1 + I2
+        d2 = m2 * (lc2 ** 2 + l1 * lc2 * np.cos(theta2)) + I2
+        phi2 = m2 * lc2 * g * np.cos(theta1 + theta2 - np.pi / 2.0)
+        phi1 = - m2 * l1 * lc2 * dtheta2 ** 2 * np.sin(theta2) \
+            - 2 * m2 * l1 * lc2 * dtheta2 * dtheta1 * np.sin(theta2) \
+            + (m1 * lc1 + m2 * l1) * g * np.cos(theta1 - np.pi / 2) + phi2
+        ddtheta2 = (torque + d2 / d1 * phi1 - m2 * l1 * lc2 * dtheta1 ** 2 * np.sin(theta2) - phi2) \
+            / (m2 * lc2 ** 2 + I2 - d2 ** 2 / d1)
+        ddtheta1 = -(d2 * ddtheta2 + phi1) / d1
+
+        return np.stack([dtheta1, dtheta2, ddtheta1, ddtheta2], axis=1)
+
+    def transition(self, actions):
+
+        torque = self.avail_torque[actions]
+
+        # a single runge-kutta step over dt
+        state = self.state
+        k1 = self.dsdt(state, torque)
+        k2 = self.dsdt(state + self.dt / 2 * k1, torque)
+        k3 = self.dsdt(state + self.dt / 2 * k2, torque)
+        k4 = self.dsdt(state + self.dt * k3, torque)
+        state = state + self.dt / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+        # angles are wrapped to [-pi, pi] and velocities bounded
+        state[:, :2] = (state[:, :2] + np.pi) % (2 * np.pi) - np.pi
+        state[:, 2] = np.clip(state[:, 2], -self.max_vel_1, self.max_vel_1)
+        state[:, 3] = np.clip(state[:, 3], -self.max_vel_2, self.max_vel_2)
+        self.state = state
+
+        terminated = -np.cos(state[:, 0]) - np.cos(state[:, 1] + state[:, 0]) > 1.0
+
+        return np.where(terminated, 0.0, -1.0), terminated
+
+    def observe(self):
+
+        theta1, theta2, dtheta1, dtheta2 = self.state.T
+        return np.stack([np.cos(theta1), np.sin(theta1), np.cos(theta2), np.sin(theta2), dtheta1, dtheta2],
+            axis=1).astype(np.float32)
+
+
+class SingleNativeEnv:
+    """ A native vectorized environment with a single copy, with the interface of a gym environment.
+
+        When an episode finishes, step returns its last observation, and the next reset returns the initial one
+    """
+
+    def __init__(self, vec_env):
+
+        self.vec_env = vec_env
+        self.observation_space = vec_env.observation_space
+        self.action_space = vec_env.action_space
+        self.next_observation = None
+
+    def reset(self):
+
+        # environment was already reset when the last episode finished
+        if self.next_observation is not None:
+            observation = self.next_observation
+            self.next_observation = None
+            return observation
+
+        return self.vec_env.reset()[0]
+
+    def step(self, action):
+
+        observations, rewards, dones, info = self.vec_env.step(np.array([action]))
+        if dones[0]:
+            self.next_observation = observations[0]
+
+        return info["final_observations"][0], float(rewards[0]), bool(dones[0]), {}
+
+
+# environments available in NumPy, by gym name, with the arguments of their registration
+NATIVE_ENVS = {
+    "FrozenLake-v0": (VectorFrozenLake, {"map_name": "4x4", "is_slippery": True, "max_episode_steps": 100}),
+    "FrozenLake-v1": (VectorFrozenLake, {"map_name": "4x4", "is_slippery": True, "max_episode_steps": 100}),
+    "FrozenLake8x8-v0": (VectorFrozenLake, {"map_name": "8x8", "is_slippery": True, "max_episode_steps": 200}),
+    "FrozenLake8x8-v1": (VectorFrozenLake, {"map_name": "8x8", "is_slippery": True, "max_episode_steps": 200}),
+    "FrozenLakeNotSlippery-v0": (VectorFrozenLake, {"map_name": "4x4", "is_slippery": False, "max_episode_steps": 100}),
+    "CartPole-v0": (VectorCartPole, {"max_episode_steps": 200}),
+    "CartPole-v1": (VectorCartPole, {"max_episode_steps": 500}),
+    "Acrobot-v1": (VectorAcrobot, {"max_episode_steps": 500}),
+}
+
+def make_native_env(env_name, num_envs):
+    """ Vectorized version of a gym environment, with num_envs copies """
+
+    if env_name not in NATIVE_ENVS:
+        raise Exception("Environment {} has no native version. Available: {}".format(env_name, ", ".join(NATIVE_ENVS)))
+
+    env_class, kwargs = NATIVE_ENVS[env_name]
+    return env_class(num_envs, **kwargs)
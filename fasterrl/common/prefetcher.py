@@ -0,0 +1,187 @@
+"""
+    Prepares minibatches in a background thread, while the agent interacts with the environment
+
+"""
+
+import threading
+import queue
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+from fasterrl.common.buffer import batch_length
+
+__all__ = [
+    "PrefetchedBatch",
+    "SynchronizedBuffer",
+    "BatchPrefetcher"
+]
+
+PrefetchedBatch = namedtuple('PrefetchedBatch',
+    field_names=['tensors', 'indices', 'weights_v', 'pos', 'appended'])
+
+
+class SynchronizedBuffer:
+    """ Wraps a replay buffer so every method call holds the same lock, allowing a background thread to sample from it.
+
+        Also counts experiences appended, which lets batches sampled earlier identify positions overwritten since
+    """
+
+    def __init__(self, buffer):
+
+        self.wrapped = buffer
+        self.lock = threading.RLock()
+        self.appended = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.wrapped)
+
+    def __getattr__(self, name):
+        """ Redirect everything else to the wrapped buffer, holding the lock for methods """
+
+        attr = getattr(self.wrapped, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+    def append(self, experience):
+        with self.lock:
+            self.wrapped.append(experience)
+            self.appended += 1
+
+    def receive(self, experiences):
+        with self.lock:
+            self.wrapped.receive(experiences)
+            self.appended += batch_length(experiences)
+
+    def receive_shared(self, slots):
+        with self.lock:
+            received = self.wrapped.receive_shared(slots)
+            self.appended += received
+            return received
+
+
+class BatchPrefetcher:
+    """ Keeps a queue with the next minibatches, already converted to tensors.
+
+        Sampling and conversion run on a background thread. The learner only dequeues.
+        Errors in the background thread are passed through the queue and raised to the learner.
+        For prioritized buffers, priorities of positions overwritten after the batch was sampled are not updated,
+        since they now belong to a different experience
+    """
+
+    def __init__(self, buffer, batch_size, prepare, num_batches=2, device="cpu", pin_memory=False, beta=None):
+        """
+            - buffer: a SynchronizedBuffer
+            - prepare: converts a batch sampled from the buffer into a tuple of tensors
+            - num_batches: number of minibatches prepared ahead of time
+            - pin_memory: pin tensors and copy them asynchronously to the device. prepare should return cpu tensors
+            - beta: function that returns the current beta, only for prioritized buffers
+        """
+
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.prepare = prepare
+        self.device = torch.device(device)
+        # pinning is only available with cuda
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.beta = beta
+
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stop_event = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        """ Stop the background thread """
+
+        self.stop_event.set()
+        # a thread that failed has already exited
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+
+        while not self.stop_event.is_set():
+            try:
+                batch = self.sample()
+            except Exception as error:
+                # the thread ends, the learner raises the error instead of waiting for batches
+                self.put(error)
+                return
+            self.put(batch)
+
+    def put(self, item):
+        """ Wait for space in the queue, checking regularly if should stop """
+
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def sample(self):
+        """ Sample a batch and convert to tensors """
+
+        indices, weights = None, None
+
+        # sampling is done under the lock, conversion is not
+        with self.buffer.lock:
+            if self.beta is not None:
+                batch, indices, weights = self.buffer.wrapped.sample(self.batch_size, self.beta())
+            else:
+                batch = self.buffer.wrapped.sample(self.batch_size)
+            pos = getattr(self.buffer.wrapped, "pos", 0)
+            appended = self.buffer.appended
+
+        tensors = self.prepare(batch)
+        weights_v = None
+        if weights is not None:
+            weights_v = torch.from_numpy(np.asarray(weights, dtype=np.float32))
+
+        if self.pin_memory:
+            tensors = tuple(t.pin_memory().to(self.device, non_blocking=True) for t in tensors)
+            if weights_v is not None:
+                weights_v = weights_v.pin_memory().to(self.device, non_blocking=True)
+        elif weights_v is not None:
+            weights_v = weights_v.to(self.device)
+
+        return PrefetchedBatch(tensors, indices, weights_v, pos, appended)
+
+    def get(self):
+        """ Next minibatch. Blocks until one is ready, raises the error of the background thread if it failed """
+
+        if self.error is not None:
+            raise self.error
+
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            self.error = batch
+            raise batch
+
+        return batch
+
+    def update_priorities(self, batch, batch_priorities):
+        """ Update priorities of a prefetched batch, skipping positions overwritten since it was sampled """
+
+        if hasattr(batch_priorities, "detach"):
+            batch_priorities = batch_priorities.detach().cpu().numpy()
+
+        with self.buffer.lock:
+            # positions written after sampling are the ones following the position at sampling time
+            appended = self.buffer.appended - batch.appended
+            overwritten = (batch.indices - batch.pos) % self.buffer.wrapped.capacity < appended
+            keep = ~overwritten
+            if keep.any():
+                self.buffer.wrapped.update_priorities(batch.indices[keep], batch_priorities[keep])
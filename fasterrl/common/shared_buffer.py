@@ -0,0 +1,203 @@
+"""
+    Replay storage in which experiences of all agents are kept once, in shared memory
+
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from fasterrl.common.buffer import ExperienceArray
+
+__all__ = [
+    "SharedExperiencePool",
+    "PoolStorage"
+]
+
+
+class SharedExperiencePool(ExperienceArray):
+    """ Columnar storage for the experiences of several agents, in blocks of shared memory.
+
+        An agent publishes each experience once, and peers receive only its position in the pool.
+        Besides the experience columns, the pool keeps the agent that published each position (owner)
+        and which agents have it in their buffers (visible). A position is reused when no agent sees it anymore.
+
+        Positions are managed by the process that created the pool. Other processes can attach to it
+        with the layout of the blocks, to read experiences
+    """
+
+    def __init__(self, num_agents, agent_capacity, state_dtype=None):
+
+        # each agent holds at most agent_capacity positions, plus one written before the oldest is released
+        super(SharedExperiencePool, self).__init__(num_agents * (agent_capacity + 1), state_dtype)
+
+        self.num_agents = num_agents
+        # blocks of shared memory, by column name. only the creator unlinks them
+        self.blocks = {}
+        self.creator = True
+
+        self.owner = self.create_column("owner", (), np.int16)
+        self.visible = self.create_column("visible", (num_agents,), np.bool_)
+        # stack of free positions, lowest positions are used first
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+
+    def __len__(self):
+        return self.capacity - len(self.free_slots)
+
+    def create_column(self, name, shape, dtype):
+
+        shape = (self.capacity,) + tuple(shape)
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.blocks[name] = block
+        column = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        column[:] = 0
+
+        return column
+
+    def layout(self):
+        """ Names, shapes and types of the blocks, required by other processes to attach to the pool """
+
+        columns = {}
+        for name, block in self.blocks.items():
+            column = getattr(self, name)
+            columns[name] = {"block": block.name, "shape": list(column.shape[1:]), "dtype": column.dtype.str}
+
+        return {"num_agents": self.num_agents, "capacity": self.capacity, "columns": columns}
+
+    @classmethod
+    def attach(cls, layout):
+        """ Map the blocks of a pool created in another process. Only reading is supported """
+
+        pool = cls.__new__(cls)
+        ExperienceArray.__init__(pool, layout["capacity"])
+        pool.num_agents = layout["num_agents"]
+        pool.blocks = {}
+        pool.creator = False
+        pool.free_slots = []
+
+        for name, column in layout["columns"].items():
+            block = shared_memory.SharedMemory(name=column["block"])
+            pool.blocks[name] = block
+            setattr(pool, name, np.ndarray((pool.capacity,) + tuple(column["shape"]),
+                dtype=np.dtype(column["dtype"]), buffer=block.buf))
+        pool.size = pool.capacity
+
+        return pool
+
+    def publish(self, experience, agent):
+        """ Write an experience in a free position, visible only to the agent that published it """
+
+        slot = self.free_slots.pop()
+        self[slot] = experience
+        self.size = max(self.size, slot + 1)
+        self.owner[slot] = agent
+        self.visible[slot] = False
+        self.visible[slot, agent] = True
+
+        return slot
+
+    def show(self, slots, agent):
+        """ Make positions visible to an agent """
+
+        self.visible[slots, agent] = True
+
+    def hide(self, slot, agent):
+        """ Remove a position from an agent, freeing it if no agent sees it anymore """
+
+        self.visible[slot, agent] = False
+        if not self.visible[slot].any():
+            self.free_slots.append(slot)
+
+    def close(self):
+        """ Release the shared memory. The creator also removes the blocks """
+
+        # arrays must not outlive the blocks they point to
+        for name in list(self.blocks):
+            setattr(self, name, None)
+        self.tensor_columns = None
+
+        for block in self.blocks.values():
+            block.close()
+            if self.creator:
+                block.unlink()
+        self.blocks = {}
+
+
+class PoolStorage:
+    """ Storage of a single agent, holding positions in a SharedExperiencePool.
+
+        Has the interface of ExperienceArray, so it can be used by any ring buffer.
+        Experiences written are published to the pool, while positions already in the pool,
+        received from other agents, are written as they are
+    """
+
+    def __init__(self, pool, agent, capacity):
+
+        self.pool = pool
+        self.agent = agent
+        self.capacity = capacity
+        self.size = 0
+        # total number of writes, used by ring buffers to find the next position to write
+        self.count = 0
+        # position in the pool of each experience
+        self.slots = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return self.pool[self.slots[idx]]
+
+    def __setitem__(self, idx, item):
+        """ Write an experience, or the position of an experience already in the pool """
+
+        if isinstance(item, (int, np.integer)):
+            slot = item
+            self.pool.show(slot, self.agent)
+        else:
+            slot = self.pool.publish(item, self.agent)
+
+        # released after writing, same as the frames in FrameExperienceArray
+        if idx < self.size:
+            self.pool.hide(self.slots[idx], self.agent)
+
+        self.slots[idx] = slot
+        self.count += 1
+
+    def append(self, item):
+        self[self.size] = item
+        self.size += 1
+
+    def clear(self):
+
+        for slot in self.slots[:self.size]:
+            self.pool.hide(slot, self.agent)
+        self.size = 0
+
+    def extend(self, items):
+
+        for item in items:
+            self.append(item)
+
+    def unseen(self, slots):
+        """ Positions not yet visible to the agent, with no repetitions.
+
+            Positions released by all agents since they were selected are skipped, since they may be reused
+        """
+
+        slots = np.unique(np.asarray(slots, dtype=np.int64))
+        visible = self.pool.visible[slots]
+        return slots[visible.any(axis=1) & ~visible[:, self.agent]]
+
+    def take(self, indices):
+        return self.pool.take(self.slots[indices])
+
+    def columns(self):
+        return self.pool.columns()
+
+    def empty_tensors(self, batch_size):
+        return self.pool.empty_tensors(batch_size)
+
+    def take_into(self, indices, out):
+        return self.pool.take_into(self.slots[indices], out)
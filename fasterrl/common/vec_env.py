@@ -0,0 +1,344 @@
+"""
+    Several copies of an environment stepped at once, in the same process or in worker processes
+
+"""
+
+import multiprocessing
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from fasterrl.common.environment import BaseEnv
+from fasterrl.common.native_env import make_native_env
+
+__all__ = [
+    "VecEnv",
+    "InProcessEnvs",
+    "SubprocessEnvs",
+    "NativeEnvs",
+    "copy_params"
+]
+
+
+def copy_params(params):
+    """ Params of each copy of the environment. Copies return raw observations, actions and rewards,
+        discretization and reward scaling are applied to all copies at once by the vectorized environment
+    """
+
+    params = dict(params)
+    for key in ["DISCRETIZE_STATE", "DISCRETIZE_ACTION", "SHARING", "FOCUSED_SHARING"]:
+        params[key] = False
+    params.pop("REWARD_SCALING_FACTOR", None)
+    params["NUM_ENVS"] = 1
+
+    return params
+
+
+class InProcessEnvs:
+    """ Copies of the environment stepped one after the other, in the calling process.
+
+        Copies that finish an episode are reset in the same step, as in NativeVectorEnv
+    """
+
+    def __init__(self, params, num_envs):
+
+        self.envs = [BaseEnv(params) for _ in range(num_envs)]
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+
+    def reset(self):
+
+        return np.stack([np.asarray(env.reset()) for env in self.envs])
+
+    def step(self, actions):
+        """ Returns arrays with the observation, reward and done of each copy, and the last observation of the episode """
+
+        observations, rewards, dones, final_observations = [], [], [], []
+        for env, action in zip(self.envs, actions):
+            observation, reward, done, _ = env.step(action)
+            final_observations.append(np.asarray(observation))
+            if done:
+                observation = env.reset()
+            observations.append(np.asarray(observation))
+            rewards.append(reward)
+            dones.append(done)
+
+        return (np.stack(observations), np.array(rewards, dtype=np.float64),
+            np.array(dones, dtype=bool), np.stack(final_observations))
+
+    def close(self):
+        pass
+
+
+def create_shared_array(shape, dtype):
+    """ Array in a new block of shared memory. Returns the block and the array """
+
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array[:] = 0
+
+    return block, array
+
+
+def attach_shared_block(name):
+    """ Map a block of shared memory created by another process, which also removes it """
+
+    # the block is not tracked by the worker. before 3.13 it is tracked again, by the resource tracker
+    # of the creator, shared by the workers, where registering the same block twice has no effect
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def env_worker(pipe, params, index):
+    """ Loop of a worker process, running a single copy of the environment.
+
+        Observations are written in the row index of the shared arrays, the pipe only carries commands,
+        actions, rewards and dones
+    """
+
+    # forked workers would otherwise share the random state of the parent
+    np.random.seed()
+
+    env = BaseEnv(params)
+    observation = np.asarray(env.reset())
+    pipe.send((env.observation_space, env.action_space, observation.shape, observation.dtype.str))
+
+    # map the arrays created by the parent
+    _, layout = pipe.recv()
+    blocks = [attach_shared_block(name) for name in layout["blocks"]]
+    shape = (layout["num_envs"],) + tuple(layout["shape"])
+    observations, final_observations = [np.ndarray(shape, dtype=np.dtype(layout["dtype"]), buffer=block.buf)
+        for block in blocks]
+    observations[index] = observation
+    pipe.send(None)
+
+    while True:
+        command, data = pipe.recv()
+        if command == "step":
+            observation, reward, done, _ = env.step(data)
+            final_observations[index] = observation
+            if done:
+                observation = env.reset()
+            observations[index] = observation
+            pipe.send((reward, done))
+        elif command == "reset":
+            observations[index] = env.reset()
+            pipe.send(None)
+        elif command == "close":
+            break
+
+    # arrays must not outlive the blocks they point to
+    observations, final_observations = None, None
+    for block in blocks:
+        block.close()
+    pipe.close()
+
+
+class SubprocessEnvs:
+    """ Copies of the environment in worker processes, stepped in parallel.
+
+        Workers write the observations in arrays of shared memory, so only actions, rewards and dones
+        are exchanged through pipes. Copies that finish an episode are reset in the same step
+    """
+
+    def __init__(self, params, num_envs, start_method=None):
+
+        self.num_envs = num_envs
+        context = multiprocessing.get_context(start_method)
+
+        # workers use the resource tracker of this process, started before them, with any start method.
+        # otherwise a forked worker could start its own, which removes the blocks when the worker exits
+        resource_tracker.ensure_running()
+
+        self.pipes = []
+        self.processes = []
+        for index in range(num_envs):
+            pipe, worker_pipe = context.Pipe()
+            process = context.Process(target=env_worker, args=(worker_pipe, params, index), daemon=True)
+            process.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+        # spaces and the format of the observations are reported by the workers, once the environments are created
+        specs = [pipe.recv() for pipe in self.pipes]
+        self.observation_space, self.action_space, shape, dtype = specs[0]
+
+        # observations of the current step, and last observations of the episodes that finished in the step
+        shape = (num_envs,) + tuple(shape)
+        self.observations_block, self.observations = create_shared_array(shape, dtype)
+        self.final_observations_block, self.final_observations = create_shared_array(shape, dtype)
+
+        layout = {
+            "blocks": [self.observations_block.name, self.final_observations_block.name],
+            "num_envs": num_envs,
+            "shape": list(shape[1:]),
+            "dtype": np.dtype(dtype).str
+        }
+        for pipe in self.pipes:
+            pipe.send(("attach", layout))
+        for pipe in self.pipes:
+            pipe.recv()
+
+    def reset(self):
+
+        for pipe in self.pipes:
+            pipe.send(("reset", None))
+        for pipe in self.pipes:
+            pipe.recv()
+
+        return self.observations.copy()
+
+    def step(self, actions):
+        """ Returns arrays with the observation, reward and done of each copy, and the last observation of the episode """
+
+        # all workers step before any result is collected
+        for pipe, action in zip(self.pipes, actions):
+            pipe.send(("step", action))
+        rewards, dones = zip(*[pipe.recv() for pipe in self.pipes])
+
+        # copies, since the shared arrays are overwritten in the next step
+        return (self.observations.copy(), np.array(rewards, dtype=np.float64),
+            np.array(dones, dtype=bool), self.final_observations.copy())
+
+    def close(self):
+        """ Stop the workers and release the shared memory """
+
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+        for process in self.processes:
+            process.join()
+        for pipe in self.pipes:
+            pipe.close()
+
+        self.observations, self.final_observations = None, None
+        for block in [self.observations_block, self.final_observations_block]:
+            block.close()
+            block.unlink()
+
+
+class NativeEnvs:
+    """ Copies of a native environment, already stepped at once with array operations """
+
+    def __init__(self, env_name, num_envs):
+
+        self.env = make_native_env(env_name, num_envs)
+        self.observation_space = self.env.observation_space
+        self.action_space = self.env.action_space
+
+    def reset(self):
+
+        return self.env.reset()
+
+    def step(self, actions):
+
+        observations, rewards, dones, info = self.env.step(actions)
+
+        return observations, rewards, dones, info["final_observations"]
+
+    def close(self):
+        pass
+
+
+class VecEnv(BaseEnv):
+    """ Several copies of an environment, with step(actions) and reset() over all copies.
+
+        Observations, rewards and dones are arrays with one row per copy. Copies that finish an episode
+        are reset in the same step, and the last observation of the episode is kept in the info, under final_observations.
+        Discretization of states and actions and reward scaling are applied to all copies at once.
+
+        Copies run in the calling process (VEC_ENV_BACKEND inprocess) or in worker processes (subprocess).
+        Native environments are always stepped at once in the calling process
+    """
+
+    def __init__(self, params):
+
+        if "PLATFORM" not in params:
+            raise Exception("Please define the paramater PLATFORM. Currently supported plataforms: openai, marlo, gym-minecraft, native")
+        self.platform = params["PLATFORM"]
+
+        self.num_envs = 1
+        if "NUM_ENVS" in params:
+            self.num_envs = params["NUM_ENVS"]
+
+        self.backend = "inprocess"
+        if "VEC_ENV_BACKEND" in params:
+            self.backend = params["VEC_ENV_BACKEND"]
+
+        if self.platform == "native":
+            self.envs = NativeEnvs(params["ENV_NAME"], self.num_envs)
+        elif self.backend == "subprocess":
+            self.envs = SubprocessEnvs(copy_params(params), self.num_envs)
+        elif self.backend == "inprocess":
+            self.envs = InProcessEnvs(copy_params(params), self.num_envs)
+        else:
+            raise Exception("Unknown VEC_ENV_BACKEND {}. Currently supported backends: inprocess, subprocess".format(self.backend))
+
+        self.observation_space = self.envs.observation_space
+        self.action_space = self.envs.action_space
+
+        self.configure(params)
+
+    def step(self, actions):
+
+        # discretize actions, if required
+        actions = np.asarray(actions)
+        if self.discretize_action and not self.passive:
+            actions = self.action_discretizer.revert_batch(actions)
+
+        observations, rewards, dones, final_observations = self.envs.step(actions)
+
+        # scale rewards
+        if self.reward_scaling_factor:
+            rewards = rewards * self.reward_scaling_factor
+
+        # online discretizers learn the bins from every observation, including the first of the new episodes
+        if self.discretize_state and self.state_discretizer.sketch is not None:
+            self.state_discretizer.observe_batch(final_observations)
+            if dones.any():
+                self.state_discretizer.observe_batch(observations[dones])
+
+        # discretize observations, if required. final observations differ only where episodes finished
+        if self.discretize_state and not self.passive:
+            observations = self.state_discretizer.convert_all(observations)
+            discrete_final_observations = observations.copy()
+            if dones.any():
+                discrete_final_observations[dones] = self.state_discretizer.convert_all(final_observations[dones])
+            final_observations = discrete_final_observations
+
+        return observations, rewards, dones, {"final_observations": final_observations}
+
+    def reset(self):
+
+        observations = self.envs.reset()
+
+        # online discretizers learn the bins from every observation, even in passive mode
+        if self.discretize_state and self.state_discretizer.sketch is not None:
+            self.state_discretizer.observe_batch(observations)
+
+        # discretize observations, if required
+        if self.discretize_state and not self.passive:
+            observations = self.state_discretizer.convert_all(observations)
+
+        return observations
+
+    def close(self):
+
+        self.envs.close()
+
+    def random_true_sampling(self, count, type='state'):
+
+        samples = []
+        # interact with all copies untill it gets all samples
+        self.envs.reset()
+        while len(samples) < count:
+            actions = [self.action_space.sample() for _ in range(self.num_envs)]
+            final_observations = self.envs.step(actions)[3]
+            samples.extend(final_observations)
+        # reset after finishing sampling
+        self.envs.reset()
+
+        self.state_discretizer.define_bins_from_samples(samples[:count])
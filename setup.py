@@ -34,7 +34,7 @@ except:
     warnings.warn(f"Folder {local_path} already exists")
 
 # Create additional directories
-for folder in ["logs", "results", "runs", "weights"]:
+for folder in ["logs", "results", "runs", "weights", "buffers"]:
     folder_path = path.join(local_path,folder)
     try:
         os.mkdir(folder_path)